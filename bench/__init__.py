@@ -0,0 +1,9 @@
+"""
+Offline benchmarks for the bot.
+
+Everything runs in-process against stand-ins for Telegram, OpenAI and the
+Supabase Edge Function (see stubs.py), so no network or credentials are
+needed:
+
+    python -m bench.turns --turns 20
+"""
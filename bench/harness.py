@@ -0,0 +1,129 @@
+import asyncio
+import itertools
+import logging
+import sys
+from typing import Dict, Optional
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from bench import stubs
+
+# runs after every real handler group, so it fires once an update is fully handled
+DONE_GROUP = sys.maxsize
+
+
+class Harness:
+    """
+    The real PTB Application from bot.build_application(), wired to stubs.
+
+    Updates are built as Bot API JSON and fed through app.process_update()
+    (or the running app's update_queue, for submit()), so handler matching,
+    user_data and callback queries behave exactly as in production.
+    """
+
+    def __init__(self, openai: Optional[stubs.Fault] = None, supabase: Optional[stubs.Fault] = None,
+                 telegram: Optional[stubs.Fault] = None, verbose: bool = False):
+        stubs.configure_env()
+        import bot  # reads env at import time
+
+        if not verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.getLogger("sofia").setLevel(logging.WARNING)
+
+        self.bot = bot
+        self.stubs = stubs.Stubs(openai=openai, supabase=supabase, telegram=telegram)
+        self.stats = self.stubs.stats
+        self.app = None
+        self.running = False
+        self._update_ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def start(self, running: bool = False):
+        """running=True also starts the app, so updates go through update_queue (see submit())."""
+        self.stubs.install(self.bot)
+        self.app = self.bot.build_application(request=self.stubs.telegram)
+        await self.app.initialize()
+        if running:
+            self.app.add_handler(TypeHandler(Update, self._done), group=DONE_GROUP)
+            await self.app.start()
+            self.running = True
+
+    async def stop(self):
+        if self.running:
+            await self.app.stop()
+            self.running = False
+        await self.app.shutdown()
+        await self.bot.client.close()
+        await self.bot.supabase_client.aclose()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    # -----------------------------
+    # Users
+    # -----------------------------
+
+    def seed_user(self, user_id: int, plan: str = "pro", **facts: str):
+        """A user who already activated a plan (passes the password gate on rehydrate)."""
+        self.stubs.supabase.set_facts(user_id, {"plan": plan, "authorized": "1", "messages_used": "0", "memory_count": "0", **facts})
+
+    # -----------------------------
+    # Updates
+    # -----------------------------
+
+    def _user(self, user_id: int) -> Dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> Dict:
+        msg = {
+            "message_id": next(self._update_ids),
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return msg
+
+    async def send(self, user_id: int, text: str):
+        """Deliver a text message (or /command) from user_id and wait for the handler."""
+        data = {"update_id": next(self._update_ids), "message": self._message(user_id, text)}
+        await self.app.process_update(Update.de_json(data, self.app.bot))
+
+    def submit(self, user_id: int, text: str) -> asyncio.Future:
+        """
+        Queue a message the way polling/webhook delivery does; the future
+        resolves once every handler group has run. Needs start(running=True).
+        """
+        data = {"update_id": next(self._update_ids), "message": self._message(user_id, text)}
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[data["update_id"]] = fut
+        self.app.update_queue.put_nowait(Update.de_json(data, self.app.bot))
+        return fut
+
+    async def _done(self, update: Update, context):
+        fut = self._pending.pop(update.update_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    async def press(self, user_id: int, callback_data: str):
+        """Deliver an inline-button press from user_id."""
+        message = self._message(user_id, "⚠️ confirm?")
+        message["from"] = {"id": self.app.bot.id, "is_bot": True, "first_name": "Sofia"}
+        data = {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "message": message,
+                "data": callback_data,
+            },
+        }
+        await self.app.process_update(Update.de_json(data, self.app.bot))
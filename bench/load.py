@@ -0,0 +1,235 @@
+"""
+Concurrent-user load test: many virtual users replaying conversations.
+
+Updates go through the running Application's update_queue, the same path
+as polling/webhook delivery, with every handler from build_application().
+Each concurrency level gets fresh users; the report covers throughput,
+reply latency percentiles and event-loop lag.
+
+    python -m bench.load --users 10,100,1000 --turns 5
+    python -m bench.load --users 500 --transcripts convos.jsonl --openai-latency 0.6
+    python -m bench.load --users 200 --openai-rpm 500 --openai-tpm 200000   # with real account limits
+
+OpenAI rate limits are lifted by default so the numbers describe the bot;
+the report prints the effective limits and how many calls were shed or fell
+back, so runs with limits on can be told apart.
+
+A transcript file has one conversation per line, either a JSON list of
+user messages or {"turns": [...]}.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+import metrics
+from bench.harness import Harness
+from bench.stubs import Fault
+from bench.turns import CHAT_LINES, percentile
+
+
+def load_transcripts(path: str) -> List[List[str]]:
+    convos = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            turns = row.get("turns") if isinstance(row, dict) else row
+            turns = [t for t in turns or [] if isinstance(t, str) and t.strip()]
+            if turns:
+                convos.append(turns)
+    return convos
+
+
+def synthetic_conversation(turns: int) -> List[str]:
+    return [random.choice(CHAT_LINES) for _ in range(turns)]
+
+
+class LagMonitor:
+    """Samples how late a short sleep wakes up; that overshoot is event-loop lag."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+
+async def virtual_user(h: Harness, user_id: int, convo: List[str], think: float, latencies: List[float], timeout: float):
+    h.seed_user(user_id, difficulty="medium")
+    for text in convo:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(h.submit(user_id, text), timeout)
+        except asyncio.TimeoutError:
+            latencies.append(float("inf"))
+            return
+        latencies.append(time.perf_counter() - started)
+        if think > 0:
+            await asyncio.sleep(random.uniform(0, think))
+
+
+def degraded_counts() -> Dict[str, Dict[str, float]]:
+    """Scheduler sheds (by plan) and degraded paths taken (by kind) so far."""
+    counts = {}
+    for name, metric in (("shed", metrics.LLM_SHED), ("fallbacks", metrics.FALLBACKS)):
+        row = counts[name] = {}
+        for family in metric.collect():
+            for sample in family.samples:
+                if sample.name.endswith("_total"):
+                    row[next(iter(sample.labels.values()))] = sample.value
+    return counts
+
+
+def since(before: Dict[str, Dict[str, float]], after: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, int]]:
+    return {
+        name: {k: int(v - before.get(name, {}).get(k, 0)) for k, v in sorted(row.items()) if v - before.get(name, {}).get(k, 0)}
+        for name, row in after.items()
+    }
+
+
+async def run_level(h: Harness, users: int, convos: List[List[str]], args, first_user_id: int) -> Dict:
+    latencies: List[float] = []
+    lag = LagMonitor()
+    before = h.stats.snapshot()
+    degraded_before = degraded_counts()
+
+    lag.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        virtual_user(
+            h,
+            first_user_id + i,
+            convos[i % len(convos)] if convos else synthetic_conversation(args.turns),
+            args.think,
+            latencies,
+            args.timeout,
+        )
+        for i in range(users)
+    ))
+    wall = time.perf_counter() - started
+    await lag.stop()
+
+    done = [x for x in latencies if x != float("inf")]
+    http = h.stats.since(before)
+    degraded = since(degraded_before, degraded_counts())
+    return {
+        "users": users,
+        "openai_limits": {"rpm": round(h.bot.llm.requests.rate * 60), "tpm": round(h.bot.llm.tokens.rate * 60)},
+        "turns": len(done),
+        "timeouts": len(latencies) - len(done),
+        "wall_s": round(wall, 2),
+        "throughput_tps": round(len(done) / wall, 1) if wall else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(done, 0.50) * 1000, 1),
+            "p95": round(percentile(done, 0.95) * 1000, 1),
+            "p99": round(percentile(done, 0.99) * 1000, 1),
+            "max": round(max(done, default=0.0) * 1000, 1),
+        },
+        "loop_lag_ms": {
+            "p50": round(percentile(lag.samples, 0.50) * 1000, 1),
+            "p99": round(percentile(lag.samples, 0.99) * 1000, 1),
+            "max": round(max(lag.samples, default=0.0) * 1000, 1),
+        },
+        "http_calls": {svc: row["calls"] for svc, row in sorted(http.items()) if row["calls"]},
+        "http_errors": sum(row["errors"] for row in http.values()),
+        "llm_shed": degraded["shed"],
+        "fallbacks": degraded["fallbacks"],
+    }
+
+
+def print_table(reports: List[Dict]):
+    if reports:
+        limits = reports[0]["openai_limits"]
+        print(f"OpenAI limits: {limits['rpm']} rpm, {limits['tpm']} tpm")
+    print(
+        f"{'users':>6} {'turns':>7} {'t/s':>8} {'p50 ms':>8} {'p95':>8} {'p99':>8} {'lag p99':>8} {'lag max':>8} "
+        f"{'timeouts':>8} {'shed':>6} {'fallback':>8}"
+    )
+    for r in reports:
+        lat, lag = r["latency_ms"], r["loop_lag_ms"]
+        print(
+            f"{r['users']:>6} {r['turns']:>7} {r['throughput_tps']:>8.1f} {lat['p50']:>8.1f} {lat['p95']:>8.1f} "
+            f"{lat['p99']:>8.1f} {lag['p99']:>8.1f} {lag['max']:>8.1f} {r['timeouts']:>8} "
+            f"{sum(r['llm_shed'].values()):>6} {sum(r['fallbacks'].values()):>8}"
+        )
+
+
+async def run(args) -> List[Dict]:
+    random.seed(args.seed)
+    # read by llm_scheduler when bot is imported (in Harness())
+    if args.openai_rpm:
+        os.environ["OPENAI_RPM"] = str(args.openai_rpm)
+    if args.openai_tpm:
+        os.environ["OPENAI_TPM"] = str(args.openai_tpm)
+    convos = load_transcripts(args.transcripts) if args.transcripts else []
+    faults = {
+        "openai": Fault(args.openai_latency, args.jitter * args.openai_latency, args.openai_errors),
+        "supabase": Fault(args.supabase_latency, args.jitter * args.supabase_latency, args.supabase_errors),
+        "telegram": Fault(args.telegram_latency, args.jitter * args.telegram_latency, args.telegram_errors),
+    }
+
+    h = Harness(verbose=args.verbose, **faults)
+    await h.start(running=True)
+    try:
+        reports = []
+        next_user = 100_000
+        for users in args.users:
+            reports.append(await run_level(h, users, convos, args, next_user))
+            next_user += users
+        return reports
+    finally:
+        await h.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-user load test against the stubbed bot.")
+    parser.add_argument("--users", type=lambda s: [int(x) for x in s.split(",")], default=[10, 100, 1000],
+                        help="comma-separated concurrency levels, e.g. 10,100,1000")
+    parser.add_argument("--turns", type=int, default=5, help="turns per synthetic conversation")
+    parser.add_argument("--transcripts", help="JSONL file of recorded conversations to replay")
+    parser.add_argument("--think", type=float, default=0.0, help="max random pause between a user's turns (s)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="give up on a turn after this many seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency jitter as a fraction of latency")
+    for service, latency in (("openai", 0.4), ("supabase", 0.03), ("telegram", 0.05)):
+        parser.add_argument(f"--{service}-latency", type=float, default=latency, metavar="SECONDS")
+        parser.add_argument(f"--{service}-errors", type=float, default=0.0, metavar="RATE")
+    parser.add_argument("--openai-rpm", type=int, help="OpenAI requests/minute for the scheduler (default: unlimited)")
+    parser.add_argument("--openai-tpm", type=int, help="OpenAI tokens/minute for the scheduler (default: unlimited)")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args(argv)
+
+    reports = asyncio.run(run(args))
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(reports)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+In-process stand-ins for Telegram, OpenAI and Supabase.
+
+Each stub sits behind a transport that adds configurable latency and
+errors and counts calls and bytes per service, so a benchmark can report
+what one turn costs on the wire without touching the network.
+"""
+import os
+import json
+import random
+import asyncio
+import tempfile
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qs
+
+import httpx
+from telegram.request import BaseRequest
+
+from fake_edge import EdgeStore
+
+TELEGRAM_TOKEN = "123456:bench"
+BOT_PASSWORD = "bench-password"
+EDGE_URL = "http://supabase.stub/functions/v1/memory"
+SUPABASE_URL = "http://supabase.stub"
+
+
+def configure_env():
+    """Env for importing bot.py offline; call before `import bot`."""
+    os.environ.setdefault("TELEGRAM_TOKEN", TELEGRAM_TOKEN)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ.setdefault("SUPABASE_ANON_KEY", "bench")
+    os.environ.setdefault("BOT_PASSWORD", BOT_PASSWORD)
+    os.environ.setdefault("DEV_PASSWORD", "bench-dev")
+    os.environ["SUPABASE_URL"] = SUPABASE_URL
+    os.environ["SUPABASE_EDGE_URL"] = EDGE_URL
+    # measure the pipeline, not the humanized typing delay
+    os.environ["REPLY_DELAY_MIN"] = "0"
+    os.environ["REPLY_DELAY_MAX"] = "0"
+    os.environ["MIN_CHUNK_GAP"] = "0"
+    # the scheduler's tier-1 defaults would make a load test measure the rate limiter;
+    # set OPENAI_RPM/OPENAI_TPM (or bench.load --openai-rpm/--openai-tpm) to test it
+    os.environ.setdefault("OPENAI_RPM", "1000000")
+    os.environ.setdefault("OPENAI_TPM", "1000000000")
+    os.environ["SESSION_SNAPSHOT"] = os.path.join(tempfile.gettempdir(), "sofia-bench-sessions.ndjson")
+
+
+# =============================
+# Latency / error injection + accounting
+# =============================
+
+class Fault:
+    """Per-service latency (seconds, +/- jitter) and error rate (0..1)."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def delay(self):
+        d = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if d > 0:
+            await asyncio.sleep(d)
+
+    def fails(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class HttpStats:
+    """Outbound calls, errors and bytes per service."""
+
+    FIELDS = ("calls", "errors", "bytes_out", "bytes_in")
+
+    def __init__(self):
+        self.by_service: Dict[str, Dict[str, int]] = {}
+
+    def record(self, service: str, bytes_out: int, bytes_in: int, error: bool = False):
+        row = self.by_service.setdefault(service, dict.fromkeys(self.FIELDS, 0))
+        row["calls"] += 1
+        row["errors"] += int(error)
+        row["bytes_out"] += bytes_out
+        row["bytes_in"] += bytes_in
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {k: dict(v) for k, v in self.by_service.items()}
+
+    def since(self, before: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+        out = {}
+        for service, row in self.by_service.items():
+            prev = before.get(service, {})
+            out[service] = {f: row[f] - prev.get(f, 0) for f in self.FIELDS}
+        return out
+
+
+class StubTransport(httpx.AsyncBaseTransport):
+    """httpx transport that answers from `handler(request) -> Response` in-process."""
+
+    def __init__(self, service: str, handler: Callable[[httpx.Request], httpx.Response], stats: HttpStats, fault: Fault):
+        self.service = service
+        self.handler = handler
+        self.stats = stats
+        self.fault = fault
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        await self.fault.delay()
+        if self.fault.fails():
+            resp = httpx.Response(503, json={"error": {"message": "injected failure"}})
+        else:
+            resp = self.handler(request)
+        content = await resp.aread()
+        self.stats.record(self.service, len(body), len(content), error=resp.status_code >= 400)
+        return resp
+
+
+# =============================
+# Supabase: Edge Function + user_plans REST
+# =============================
+
+class SupabaseStub:
+    def __init__(self):
+        self.edge = EdgeStore()
+        # email -> user_plans row
+        self.user_plans: Dict[str, Dict] = {}
+
+    def add_purchase(self, email: str, plan: str):
+        self.user_plans[email] = {"email": email, "plan": plan, "telegram_id": None}
+
+    def set_facts(self, user_id: int, facts: Dict[str, str]):
+        self.edge.facts[str(user_id)] = dict(facts)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.startswith("/rest/v1/user_plans"):
+            return self._user_plans(request)
+        status, payload = self.edge.handle(json.loads(request.content or b"{}"))
+        return httpx.Response(status, json=payload)
+
+    def _user_plans(self, request: httpx.Request) -> httpx.Response:
+        params = parse_qs(request.url.query.decode())
+        email = params.get("email", [""])[0]
+
+        if request.method == "GET" and email.startswith("in.("):
+            wanted = [e.strip('"') for e in email[len("in.("):-1].split(",")]
+            return httpx.Response(200, json=[self.user_plans[e] for e in wanted if e in self.user_plans])
+
+        email = email.removeprefix("eq.")
+        row = self.user_plans.get(email)
+
+        if request.method == "GET":
+            return httpx.Response(200, json=[row] if row else [])
+
+        if request.method == "PATCH" and row:
+            row.update(json.loads(request.content or b"{}"))
+        return httpx.Response(204)
+
+
+# =============================
+# OpenAI chat completions
+# =============================
+
+REPLY_TEXT = "haha okay, you're kind of fun. so what do you do when you're not texting me? tell me something real."
+COACH_TEXT = (
+    "bold move, but let's tighten it up. "
+    + " ".join(f"{i}. keep it light, ask one specific question, and make a clear plan instead of waiting for her to lead." for i in range(1, 5))
+)
+
+
+class OpenAIStub:
+    """Answers chat.completions: JSON mode for analysis calls, text (or SSE) for replies."""
+
+    def __init__(self, reply_text: str = REPLY_TEXT, coach_text: str = COACH_TEXT):
+        self.reply_text = reply_text
+        self.coach_text = coach_text
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        messages = body.get("messages") or []
+        system = messages[0]["content"] if messages else ""
+        user = messages[-1]["content"] if messages else ""
+
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            text = json.dumps(self._analysis(user))
+        elif "Coach" in system:
+            text = self.coach_text
+        else:
+            text = self.reply_text
+
+        if body.get("stream"):
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=self._sse(text))
+
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+        completion_tokens = len(text) // 4
+        return httpx.Response(200, json={
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    @staticmethod
+    def _analysis(user_prompt: str) -> Dict:
+        # one object that satisfies both the scorer and the fact extractor
+        text = user_prompt.lower()
+        data = {"flirty": 4 + 3 * ("cute" in text or "date" in text), "personality": 5 + 2 * ("?" in text),
+                "rationale": "bench", "fact": "", "value": "", "confidence": 0.0}
+        if "i like " in text:
+            value = text.split("i like ", 1)[1].split(".")[0].strip()[:40]
+            data.update(fact="favorite_hobby", value=value, confidence=0.9)
+        return data
+
+    @staticmethod
+    def _sse(text: str, chunk: int = 8) -> bytes:
+        events = []
+        for i in range(0, len(text), chunk):
+            events.append("data: " + json.dumps({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "gpt-4o-mini",
+                "choices": [{"index": 0, "delta": {"content": text[i:i + chunk]}, "finish_reason": None}],
+            }))
+        events.append("data: [DONE]")
+        return ("\n\n".join(events) + "\n\n").encode()
+
+
+# =============================
+# Telegram Bot API
+# =============================
+
+class TelegramStub(BaseRequest):
+    """PTB request backend that answers Bot API calls locally."""
+
+    def __init__(self, stats: HttpStats, fault: Fault):
+        self.stats = stats
+        self.fault = fault
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        sent = len(request_data.json_payload) if request_data else 0
+
+        await self.fault.delay()
+        if self.fault.fails() and endpoint != "getMe":
+            status, payload = 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        else:
+            status, payload = 200, {"ok": True, "result": self._result(endpoint, params)}
+
+        data = json.dumps(payload).encode()
+        self.stats.record("telegram", sent, len(data), error=status >= 400)
+        return status, data
+
+    def _result(self, endpoint: str, params: Dict):
+        if endpoint == "getMe":
+            return {"id": int(TELEGRAM_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Sofia", "username": "sofia_bench_bot"}
+        if endpoint in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": 0,
+                "chat": {"id": params.get("chat_id") or 0, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+# =============================
+# Wiring
+# =============================
+
+class Stubs:
+    """All three stand-ins plus shared accounting."""
+
+    def __init__(self, openai: Optional[Fault] = None, supabase: Optional[Fault] = None, telegram: Optional[Fault] = None):
+        self.stats = HttpStats()
+        self.supabase = SupabaseStub()
+        self.openai = OpenAIStub()
+        self.faults = {
+            "openai": openai or Fault(),
+            "supabase": supabase or Fault(),
+            "telegram": telegram or Fault(),
+        }
+        self.telegram = TelegramStub(self.stats, self.faults["telegram"])
+
+    def install(self, bot_module):
+        """Point the bot's OpenAI and Supabase clients at the stubs."""
+        import supabase_client
+        from openai import AsyncOpenAI
+
+        bot_module.client = AsyncOpenAI(
+            api_key="sk-bench",
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                transport=StubTransport("openai", self.openai.handle, self.stats, self.faults["openai"])
+            ),
+        )
+        # swap the pooled client get_client() hands out
+        supabase_client._client = httpx.AsyncClient(
+            timeout=supabase_client.HTTP_TIMEOUT,
+            transport=StubTransport("supabase", self.supabase.handle, self.stats, self.faults["supabase"]),
+        )
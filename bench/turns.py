@@ -0,0 +1,184 @@
+"""
+Per-turn benchmark: wall time, outbound HTTP calls and bytes per scenario.
+
+    python -m bench.turns --turns 20
+    python -m bench.turns --openai-latency 0.4 --supabase-latency 0.05 --supabase-errors 0.05 --json
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from typing import Dict, List
+
+from bench.harness import Harness
+from bench.stubs import BOT_PASSWORD, Fault
+
+CHAT_LINES = [
+    "hey, how's your day going?",
+    "i like hiking on weekends. you?",
+    "you seem cute, what are you up to tonight?",
+    "honestly i just got back from the gym",
+    "what kind of music are you into?",
+    "we should grab a coffee date sometime",
+    "i like cooking italian food. it's my thing",
+    "haha you're trouble, aren't you?",
+]
+
+COACH_LINES = [
+    "how do i text a girl i met at a party?",
+    "she left me on read, what now?",
+    "how do i ask her out without being weird?",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Recorder:
+    """Collects wall time + HTTP deltas per turn for one scenario."""
+
+    def __init__(self, harness: Harness, name: str):
+        self.harness = harness
+        self.name = name
+        self.walls: List[float] = []
+        self.http: Dict[str, Dict[str, int]] = {}
+
+    async def turn(self, coro):
+        before = self.harness.stats.snapshot()
+        started = time.perf_counter()
+        await coro
+        self.walls.append(time.perf_counter() - started)
+        for service, row in self.harness.stats.since(before).items():
+            total = self.http.setdefault(service, dict.fromkeys(row, 0))
+            for k, v in row.items():
+                total[k] += v
+
+    def report(self) -> Dict:
+        n = len(self.walls) or 1
+        return {
+            "scenario": self.name,
+            "turns": len(self.walls),
+            "wall_ms": {
+                "mean": round(statistics.fmean(self.walls) * 1000, 2) if self.walls else 0.0,
+                "p50": round(percentile(self.walls, 0.5) * 1000, 2),
+                "p95": round(percentile(self.walls, 0.95) * 1000, 2),
+                "max": round(max(self.walls, default=0.0) * 1000, 2),
+            },
+            "per_turn": {
+                service: {k: round(v / n, 2) for k, v in row.items()}
+                for service, row in sorted(self.http.items())
+                if row["calls"]
+            },
+        }
+
+
+# =============================
+# Scenarios
+# =============================
+
+async def bench_chat(h: Harness, turns: int) -> Recorder:
+    rec = Recorder(h, "chat")
+    user_id = 1001
+    h.seed_user(user_id, difficulty="medium")
+    for i in range(turns):
+        await rec.turn(h.send(user_id, CHAT_LINES[i % len(CHAT_LINES)]))
+    return rec
+
+
+async def bench_coach(h: Harness, turns: int) -> Recorder:
+    rec = Recorder(h, "coach")
+    user_id = 2001
+    h.seed_user(user_id, difficulty="coach")
+    for i in range(turns):
+        await rec.turn(h.send(user_id, COACH_LINES[i % len(COACH_LINES)]))
+    return rec
+
+
+async def bench_activation(h: Harness, turns: int) -> Recorder:
+    """Password + email for a fresh user each time (two updates per turn)."""
+    rec = Recorder(h, "activation")
+
+    async def activate(user_id: int, email: str):
+        await h.send(user_id, BOT_PASSWORD)
+        await h.send(user_id, email)
+
+    for i in range(turns):
+        email = f"buyer{i}@example.com"
+        h.stubs.supabase.add_purchase(email, random.choice(["starter", "pro", "elite"]))
+        await rec.turn(activate(3001 + i, email))
+    return rec
+
+
+async def bench_resetmemory(h: Harness, turns: int) -> Recorder:
+    rec = Recorder(h, "resetmemory")
+    for i in range(turns):
+        user_id = 4001 + i
+        h.seed_user(user_id, favorite_hobby="hiking", city="lisbon", job="designer", memory_count="3")
+        await rec.turn(h.press(user_id, "reset_memory_confirm"))
+    return rec
+
+
+SCENARIOS = {
+    "chat": bench_chat,
+    "coach": bench_coach,
+    "activation": bench_activation,
+    "resetmemory": bench_resetmemory,
+}
+
+
+def print_table(reports: List[Dict]):
+    print(f"{'scenario':<12} {'turns':>5} {'mean ms':>9} {'p50':>8} {'p95':>8} {'max':>8}   per-turn HTTP")
+    for r in reports:
+        w = r["wall_ms"]
+        http = ", ".join(
+            f"{svc} {row['calls']:g} calls/{row['errors']:g} err/{row['bytes_out']:.0f}B out/{row['bytes_in']:.0f}B in"
+            for svc, row in r["per_turn"].items()
+        )
+        print(f"{r['scenario']:<12} {r['turns']:>5} {w['mean']:>9.2f} {w['p50']:>8.2f} {w['p95']:>8.2f} {w['max']:>8.2f}   {http}")
+
+
+async def run(args) -> List[Dict]:
+    random.seed(args.seed)
+    faults = {
+        "openai": Fault(args.openai_latency, args.jitter * args.openai_latency, args.openai_errors),
+        "supabase": Fault(args.supabase_latency, args.jitter * args.supabase_latency, args.supabase_errors),
+        "telegram": Fault(args.telegram_latency, args.jitter * args.telegram_latency, args.telegram_errors),
+    }
+    async with Harness(verbose=args.verbose, **faults) as h:
+        reports = []
+        for name in args.scenario or SCENARIOS:
+            rec = await SCENARIOS[name](h, args.turns)
+            reports.append(rec.report())
+        return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline per-turn benchmark for the chat pipeline.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="repeatable; default: all")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency jitter as a fraction of latency")
+    for service in ("openai", "supabase", "telegram"):
+        parser.add_argument(f"--{service}-latency", type=float, default=0.0, metavar="SECONDS")
+        parser.add_argument(f"--{service}-errors", type=float, default=0.0, metavar="RATE")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args(argv)
+
+    reports = asyncio.run(run(args))
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(reports)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,14 @@ import re
 import json
 import time
 import logging
-import threading
-from typing import Dict, Tuple
+import signal
+import secrets
+from typing import Dict, Optional, Tuple
 
 from dotenv import load_dotenv
 load_dotenv()
 
-import requests
-from flask import Flask
-
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,28 +19,124 @@ from telegram.ext import (
     filters,
 )
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 import asyncio
 import random
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackQueryHandler
+from telegram.request import BaseRequest
 
 import pytz
-from datetime import time as dt_time
+from datetime import datetime
+
+from pacing import ReplyPacer
+from coach_cache import CoachCache
+from http_server import build_web_app, start_http_server
+from prompt_builder import PromptBuilder, estimate_tokens
+from fact_select import INTERNAL_FACT_KEYS, select_facts
+from sessions import Session, SessionStore, encode_rows, write_lines
+from update_processor import PerUserUpdateProcessor
+from broadcast import Broadcaster
+from llm_scheduler import LLMScheduler
+from usage import UsageCounters
+from prescorer import ExampleLog, PreScorer, Prediction
+from entitlements import PLANS, MESSAGE_LIMITS, Entitlement, EntitlementCache, normalize_plan
+
+import metrics
+import tracing
+import supabase_client
+from supabase_client import (
+    load_facts,
+    update_fact,
+    update_facts,
+    delete_facts,
+    cas_fact,
+    increment_counters,
+    scan_users,
+    set_fact_for_users,
+    get_plan_by_email,
+    fetch_user_plan,
+    fetch_user_plans,
+    forget_user_plan,
+    set_email_owner,
+)
+
+# sentence boundary used to split replies into separate Telegram messages
+SENTENCE_BREAK = r'(?<=[.!?])\s+'
 
-async def send_split_message(update: Update, text: str, min_delay: int = 1, max_delay: int = 3):
-    parts = re.split(r'(?<=[.!?])\s+', text)
-    for i, p in enumerate(parts):
+REPLY_FALLBACK = "hmm. say that again, but clearer."
+
+async def send_split_message(update: Update, text: str, pacer: ReplyPacer, max_parts: int = None):
+    parts = re.split(SENTENCE_BREAK, text)
+    sent = 0
+    for p in parts:
         chunk = p.strip()
         if chunk:
-            await send_typing(update)
-            await update.message.reply_text(chunk)
+            # pacer spaces chunks out like typing, within the reply's total delay budget
+            await pacer.reply(update.message, chunk)
+            sent += 1
+            if max_parts and sent >= max_parts:
+                break
+
+async def send_streamed_message(update: Update, open_stream, pacer: ReplyPacer) -> str:
+    """
+    Like send_split_message, but consumes an OpenAI token stream and sends
+    each sentence as soon as it is complete. open_stream is the awaitable
+    returned by openai_chat(..., stream=True).
+    Returns the full reply text (REPLY_FALLBACK if nothing came through).
+    """
+    sentences: asyncio.Queue = asyncio.Queue()
+    full = []
+
+    async def produce():
+        buf = ""
+        try:
+            stream = await open_stream
+            with tracing.span("openai.reply.stream"):
+                async for event in stream:
+                    delta = event.choices[0].delta.content if event.choices else None
+                    if not delta:
+                        continue
+                    full.append(delta)
+                    buf += delta
+                    # everything before the last boundary is a finished sentence
+                    *done, buf = re.split(SENTENCE_BREAK, buf)
+                    for p in done:
+                        sentences.put_nowait(p)
+        except Exception as e:
+            log.error(f"OpenAI reply error: {e}")
+        finally:
+            sentences.put_nowait(buf)
+            sentences.put_nowait(None)
+
+    # keep generating while we pause between messages
+    producer = asyncio.create_task(produce())
+
+    sent = 0
+    try:
+        while True:
+            p = await sentences.get()
+            if p is None:
+                break
+            chunk = p.strip()
+            if not chunk:
+                continue
+            await pacer.reply(update.message, chunk)
+            sent += 1
+    finally:
+        # a failed send (or cancelled turn) must not leave the stream running
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
 
-            # add delay between messages except after the last one
-            if i < len(parts) - 1:
-                delay = random.randint(min_delay, max_delay)
-                await asyncio.sleep(delay)
+    if not sent:
+        await send_split_message(update, REPLY_FALLBACK, pacer)
+        return REPLY_FALLBACK
+
+    return "".join(full).strip()
 
 # =============================
 # Environment & Globals
@@ -54,42 +148,88 @@ SUPABASE_EDGE_URL = os.getenv("SUPABASE_EDGE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")  # using anon for Edge Function auth
 BOT_PASSWORD = os.getenv("BOT_PASSWORD")
 DEV_PASSWORD = os.getenv("DEV_PASSWORD")
+# fact set once a user passes the password gate
+AUTHORIZED_FACT = "authorized"
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"  # send sentences as they stream in
+COACH_CACHE = os.getenv("COACH_CACHE", "0") == "1"  # opt-in: reuse answers to repeated coach questions
+FACT_TOKEN_BUDGET = int(os.getenv("FACT_TOKEN_BUDGET", "200"))  # max prompt tokens spent on known facts
+
+# Local pre-scorer (prescorer.py): trivial messages skip the LLM scorer when trained weights exist
+SCORER_WEIGHTS = os.getenv("SCORER_WEIGHTS", "prescorer_weights.json")
+SCORER_LOG = os.getenv("SCORER_LOG")  # JSONL of scored messages = training/replay data (contains message text)
+SCORER_AUDIT_RATE = float(os.getenv("SCORER_AUDIT_RATE", "0.02"))  # share of local decisions re-checked by the LLM
+
+# Update delivery: "polling" (getUpdates) or "webhook" (Telegram POSTs to our HTTP server)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+PORT = int(os.getenv("PORT", "10000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL, e.g. https://sofia.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# checked against X-Telegram-Bot-Api-Secret-Token; if unset, a random one is generated and
+# registered with set_webhook() at startup, so the route is never served unauthenticated
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# Updates run concurrently (one at a time per user), capped globally
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "4096"))  # incl. ones queued behind the same user
+
+# Plan changes pushed by Sellfy/Supabase; the route is only served when the secret is set
+PLAN_WEBHOOK_PATH = os.getenv("PLAN_WEBHOOK_PATH", "/hooks/plan")
+PLAN_WEBHOOK_SECRET = os.getenv("PLAN_WEBHOOK_SECRET")  # checked against X-Webhook-Secret
 EDGE_AUTH_KEY = SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY  # prefer service role if available
 
-DEV_USERS = set()
-
 assert TELEGRAM_TOKEN, "Missing TELEGRAM_TOKEN"
 assert OPENAI_API_KEY, "Missing OPENAI_API_KEY"
 assert SUPABASE_EDGE_URL, "Missing SUPABASE_EDGE_URL"
 assert SUPABASE_ANON_KEY, "Missing SUPABASE_ANON_KEY"
 assert BOT_PASSWORD, "Missing BOT_PASSWORD"
 
-# OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# OpenAI client (async, shared connection pool); retries are left to the scheduler
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# RPM/TPM admission + plan-priority queue in front of every OpenAI call
+llm = LLMScheduler()
+LLM_DEFAULT_COMPLETION_TOKENS = 300  # budgeted when a call sets no max_tokens
+
+# Coach Mode answer cache (only used when COACH_CACHE=1)
+coach_cache = CoachCache(
+    max_keys=int(os.getenv("COACH_CACHE_MAX_KEYS", "500")),
+    ttl=float(os.getenv("COACH_CACHE_TTL", "86400")),
+    variants=int(os.getenv("COACH_CACHE_VARIANTS", "3")),
+)
 
 # Logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 log = logging.getLogger("sofia")
 
-# Flask keep-alive (Render)
-flask_app = Flask(__name__)
-
-@flask_app.route("/")
-def home():
-    return "Bot is alive!"
-
-@flask_app.route("/ping")
-def ping():
-    return "ok"
-
 # =============================
 # In-memory session state
 # =============================
-AUTHORIZED_USERS = set()
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "600"))
+
+# user_id -> Session (bounded; evicted sessions rehydrate from Supabase facts)
+SESSIONS = SessionStore(
+    max_size=int(os.getenv("SESSION_MAX", "10000")),
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL", str(6 * 3600))),
+)
+
+metrics.SESSIONS.set_function(lambda: len(SESSIONS))
+metrics.AUTHORIZED_SESSIONS.set_function(lambda: sum(1 for _ in SESSIONS.authorized_users()))
+metrics.FACT_CACHE_USERS.set_function(lambda: len(supabase_client.fact_cache))
+
+# warm restarts: sessions are checkpointed to this NDJSON file and reloaded at startup
+SESSION_SNAPSHOT = os.getenv("SESSION_SNAPSHOT", "sessions.ndjson")
+SESSION_SNAPSHOT_INTERVAL = int(os.getenv("SESSION_SNAPSHOT_INTERVAL", "60"))
+SNAPSHOT_PREFETCH = int(os.getenv("SNAPSHOT_PREFETCH", "200"))  # hot users whose facts get preloaded
+SNAPSHOT_PREFETCH_CONCURRENCY = 16
 
-# user_id -> state
-USER_STATE: Dict[int, Dict] = {}
+# daily mood reminder, sent at this local hour in each user's timezone
+MOOD_REMINDER_HOUR = int(os.getenv("MOOD_REMINDER_HOUR", "10"))
+MOOD_REMINDER_TZ = os.getenv("MOOD_REMINDER_TZ", "UTC")  # for users who never set /timezone
+MOOD_REMINDER_WINDOW = 2  # hours after MOOD_REMINDER_HOUR that still count (covers restarts)
+MOOD_REMINDER_TICK = int(os.getenv("MOOD_REMINDER_TICK", "300"))
+# how often the reminder re-reads every recipient from Supabase; ticks in between use the roster in memory
+MOOD_ROSTER_TTL = float(os.getenv("MOOD_ROSTER_TTL", str(6 * 3600)))
 
 DIFFICULTY_THRESHOLDS = {
     "easy":   {"bad_max": 3.9, "good_max": 6.9},  # excellent >= 7.0
@@ -176,155 +316,177 @@ Rules:
 
 }
 
-# =============================
-# Supabase Edge Function helpers
-# =============================
-
-def load_facts(user_id: int) -> Dict[str, str]:
-    try:
-        resp = requests.post(
-            SUPABASE_EDGE_URL,
-            headers={
-                "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-                "apikey": SUPABASE_ANON_KEY,
-                "Content-Type": "application/json",
-            },
-            json={"action": "load", "user_id": str(user_id)},
-            timeout=8,
-        )
-
-        log.info(f"load_facts({user_id}) -> {resp.status_code} {resp.text}")
-
-        if resp.ok:
-            data = resp.json() or []
-            return {row["key"]: row["value"] for row in data}
-        else:
-            log.error(f"load_facts failed with status {resp.status_code}: {resp.text}")
-    except Exception as e:
-        log.exception(f"load_facts exception: {e}")
-
-    return {}
-
-
-def update_fact(user_id: int, key: str, value: str) -> bool:
-    try:
-        payload = {
-            "action": "update",
-            "user_id": str(user_id),
-            "key": key,
-            "value": value,
-        }
-        resp = requests.post(
-            SUPABASE_EDGE_URL,
-            headers={
-                "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-                "apikey": SUPABASE_ANON_KEY,
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=8,
-        )
-
-        log.info(
-            f"update_fact(user_id={user_id}, key={key}, value={value}) "
-            f"-> {resp.status_code} {resp.text}"
-        )
+SPICY_MODE_PROMPT = (
+    """
+SPICY_MODE:
+- Speak in a seductive, suggestive, and playful tone.
+- Lean into sexual tension and flirty innuendo.
+- If the user flirts directly or says something bold (e.g. "I want to be in bed with you"),
+  flirt back instead of deflecting or acting shy.
+- Ask teasing questions like "oh really? what would you do if you were here right now?".
+- Be more direct, confident, and playful than normal.
+- Avoid neutral replies like "that's bold".
+- Never describe explicit sexual acts. Stay suggestive, not graphic.
+    """
+).strip()
 
-        return resp.ok
+BOSS_MODE_PROMPT = "BOSS_MODE: be cold, short, and dismissive for ~5 replies."
 
-    except Exception as e:
-        log.exception(f"update_fact exception for key={key}: {e}")
-        return False
+BOLD_FLIRT_PHRASES = ["in bed", "kiss you", "touch you", "your lips", "your body", "on top of you"]
 
+# =============================
+# Memory helpers
+# =============================
 
-def get_memory_count(user_id: int) -> int:
-    facts = load_facts(user_id)
+async def get_memory_count(user_id: int) -> int:
+    facts = await load_facts(user_id)
     return int(facts.get("memory_count", "0"))
 
-def set_memory_count(user_id: int, count: int):
-    update_fact(user_id, "memory_count", str(count))
+async def set_memory_count(user_id: int, count: int):
+    await update_fact(user_id, "memory_count", str(count))
 
 
 # =============================
 # Plans & usage helpers
 # =============================
 
-STARTER_LIMIT = 20  # 20 free messages
+STARTER_LIMIT = MESSAGE_LIMITS["starter"]  # 20 free messages
+
+# starter messages are counted in process and flushed to Supabase in batches
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+usage = UsageCounters(
+    lambda deltas, batch_id: increment_counters("messages_used", deltas, batch_id),
+    # every reset sets messages_used to "0"; redo it if an increment landed on top
+    rezero=lambda user_ids: set_fact_for_users("messages_used", {u: "0" for u in user_ids}),
+)
+
+async def load_entitlement(user_id: int) -> Optional[Entitlement]:
+    facts = await load_facts(user_id)
+    if not facts:
+        # unknown user or failed load: answer "starter" but don't cache it
+        return None
+    return Entitlement(user_id, facts.get("plan"), email=facts.get("email"))
+
+# plan/limit/owner per user, kept fresh by the plan webhook + reconcile_entitlements()
+ENTITLEMENT_RECONCILE_INTERVAL = int(os.getenv("ENTITLEMENT_RECONCILE_INTERVAL", "1800"))
+entitlements = EntitlementCache(
+    load_entitlement,
+    ttl=float(os.getenv("ENTITLEMENT_TTL", str(6 * 3600))),
+    max_users=int(os.getenv("ENTITLEMENT_MAX_USERS", "20000")),
+)
+metrics.ENTITLEMENT_USERS.set_function(lambda: len(entitlements))
 
-def get_plan_and_usage(user_id: int) -> Tuple[str, int]:
+async def get_plan_and_usage(user_id: int) -> Tuple[str, int]:
     """
     Returns (plan, messages_used).
     Defaults: plan='starter', messages_used=0 if not set yet.
+    messages_used includes messages counted locally but not flushed yet;
+    plans without a message limit don't read it at all (returns 0).
     """
-    facts = load_facts(user_id)
-    plan = facts.get("plan", "starter").lower().strip()
-    if plan not in ("starter", "pro", "elite"):
-        plan = "starter"
+    ent = await entitlements.get(user_id)
+    if ent.limit is None:
+        return ent.plan, 0
 
+    facts = await load_facts(user_id)
     try:
         used = int(facts.get("messages_used", "0"))
     except ValueError:
         used = 0
 
-    return plan, used
+    return ent.plan, usage.current(user_id, used)
 
+def _plan_owner(row: Dict) -> Optional[int]:
+    try:
+        return int(row.get("telegram_id") or 0) or None
+    except (TypeError, ValueError):
+        return None
 
-def increment_usage_if_needed(user_id: int, plan: str, used: int) -> int:
+async def apply_plan_row(row: Dict, deleted: bool = False, source: str = "webhook") -> int:
+    """
+    Applies a user_plans row (pushed or reconciled) to the owner's plan fact
+    and entitlement. Returns how many users' entitlements changed.
     """
-    For starter plan, increments messages_used and persists it.
+    email = (row.get("email") or "").lower().strip()
+    if email:
+        forget_user_plan(email)
+
+    owner = _plan_owner(row)
+    if owner is None and email and not deleted:
+        # bare purchase rows (email, plan) don't say who activated them; user_plans does
+        record = await fetch_user_plan(email, fresh=True)
+        owner = _plan_owner(record or {})
+        if owner is None:
+            known = entitlements.by_email(email)
+            if len(known) == 1:
+                owner = known[0].user_id
+
+    # previous owners of this email (if any) re-read their facts on next use
+    stale = [ent.user_id for ent in entitlements.by_email(email) if ent.user_id != owner] if email else []
+    for user_id in stale:
+        entitlements.invalidate(user_id)
+    changed = len(stale)
+
+    plan = (row.get("plan") or "").lower().strip()
+    if deleted or owner is None or plan not in PLANS:
+        # not activated yet / removed: nothing to write, just drop what we cached
+        if owner is not None:
+            entitlements.invalidate(owner)
+            changed += 1
+        log.info(f"Plan change ({source}) for {email or owner}: invalidated {changed} entitlements")
+        return changed
+
+    facts = await load_facts(owner, fresh=True)
+    if facts.get("plan") != plan and not await update_facts(owner, {"plan": plan}):
+        log.error(f"Plan change ({source}) for user {owner}: writing the plan fact failed")
+    entitlements.update(owner, plan, email=email or None, owner=owner)
+    metrics.PLAN_CHANGES.labels(source).inc()
+    log.info(f"Plan change ({source}) for user {owner}: {facts.get('plan')} -> {plan}")
+    return changed + 1
+
+async def reconcile_entitlements(context=None):
+    """Safety net for missed webhooks: re-check cached plans against user_plans."""
+    cached = [ent for ent in entitlements.entries() if ent.email]
+    if not cached:
+        return
+
+    rows = await fetch_user_plans(ent.email for ent in cached)
+    if rows is None:
+        return
+    by_email = {(r.get("email") or "").lower(): r for r in rows}
+
+    changed = 0
+    for ent in cached:
+        row = by_email.get(ent.email)
+        if row is None:
+            continue
+        if str(row.get("telegram_id") or "") != str(ent.user_id):
+            # the email now belongs to someone else (or was released)
+            entitlements.invalidate(ent.user_id)
+            changed += 1
+        elif normalize_plan(row.get("plan")) != ent.plan:
+            changed += await apply_plan_row(row, source="reconcile")
+        else:
+            ent.owner = ent.user_id
+
+    if changed:
+        log.info(f"Entitlement reconcile: {changed} of {len(cached)} cached users changed")
+
+
+async def increment_usage_if_needed(user_id: int, plan: str, used: int) -> int:
+    """
+    For starter plan, counts the message locally (flush_usage() persists it).
     For pro/elite, does nothing.
     Returns the new used count.
     """
     if plan == "starter":
+        usage.add(user_id)
         used += 1
-        update_fact(user_id, "messages_used", str(used))
     return used
 
-
-def fetch_user_plan(email: str):
-    url = f"{SUPABASE_URL}/rest/v1/user_plans?select=*&email=eq.{email}"
-    headers = {
-        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}"
-    }
-
-    resp = requests.get(url, headers=headers)
-
-    if not resp.ok:
-        print("ERROR fetching user_plan:", resp.text)
-        return None
-
-    data = resp.json()
-
-    if not data:
-        return None
-
-    # data[0] contains ONLY: email, plan, product_id, product_name, updated_at
-    return data[0]
-
-
-def set_email_owner(email: str, telegram_id: int) -> bool:
-    """Assign a telegram_id to an email in user_plans (locks the account)."""
-    url = f"{SUPABASE_URL}/rest/v1/user_plans?email=eq.{email}"
-
-    payload = {
-        "telegram_id": str(telegram_id)
-    }
-
-    headers = {
-        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=minimal"
-    }
-
-    resp = requests.patch(url, headers=headers, data=json.dumps(payload))
-
-    if not resp.ok:
-        print("ERROR setting telegram_id:", resp.text)
-        return False
-
-    return True
+async def flush_usage(context=None):
+    flushed = await usage.flush()
+    if flushed or len(usage):
+        log.info(f"Usage flush: {flushed} users written, {len(usage)} pending")
 
 
 
@@ -337,40 +499,61 @@ def difficulty_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
-def get_user_state(user_id: int) -> Dict:
-    s = USER_STATE.get(user_id)
+async def get_user_state(user_id: int) -> Session:
+    s = SESSIONS.get(user_id)
     if not s:
-        s = {
-            "level": 1,
-            "difficulty": "medium",
-            "boss_counter": 0,
-            "boss_active": False,
-            "show_rating": False,
-            "last_bot_message": "ok, tell me something about you.",
-        }
-
         # 🧠 Load saved facts from Supabase if they exist
-        facts = load_facts(user_id)
+        facts = await load_facts(user_id)
+
+        # another handler may have rehydrated this user while we waited
+        s = SESSIONS.get(user_id)
+        if s:
+            return s
+
+        s = Session(user_id, history_budget=HISTORY_TOKEN_BUDGET)
 
-        # ✅ Restore saved level if found
+        # ✅ Restore saved level (and the version it was saved at) if found
         if "level" in facts:
             try:
-                s["level"] = int(facts["level"])
+                s.level = int(facts["level"])
+                s.level_version = int(facts.get("level_version") or 0)
             except ValueError:
                 pass
 
         # ✅ Optional — persist difficulty too if stored
         if "difficulty" in facts:
-            s["difficulty"] = facts["difficulty"]
+            s.difficulty = facts["difficulty"]
 
-        USER_STATE[user_id] = s
+        # 🔑 set only by the password gate, never by /remember
+        s.authorized = facts.get(AUTHORIZED_FACT) == "1"
+
+        # 🕒 for the daily mood reminder
+        if facts.get("timezone") in pytz.all_timezones_set:
+            s.timezone = facts["timezone"]
+
+        SESSIONS.put(s)
 
     return s
 
 
-def apply_level_change(user_id: int, change: int, max_level: int) -> int:
-    s = get_user_state(user_id)
-    before = s["level"]
+async def is_authorized(user_id: int) -> bool:
+    """Password-gate check that doesn't keep a session around for strangers."""
+    s = SESSIONS.peek(user_id)
+    if s:
+        return s.authorized
+    # same rule get_user_state applies on rehydration
+    return (await load_facts(user_id)).get(AUTHORIZED_FACT) == "1"
+
+
+def is_dev(user_id: int) -> bool:
+    # dev mode only lives in the session, so no session means no dev mode
+    s = SESSIONS.peek(user_id)
+    return bool(s and s.dev)
+
+
+async def apply_level_change(user_id: int, change: int, max_level: int) -> int:
+    s = await get_user_state(user_id)
+    before = s.level
     target = max(1, min(max_level, before + change))
 
     # no-op shortcut (still log)
@@ -378,33 +561,30 @@ def apply_level_change(user_id: int, change: int, max_level: int) -> int:
         log.info(f"Level unchanged for user {user_id}: {before} + ({change}) -> {target}")
         return before
 
-    s["level"] = target
+    s.level = target
+
+    # persist only if nobody changed the level since we read it (e.g. /setlevel)
+    ok, db_level, version = await cas_fact(user_id, "level", str(s.level), s.level_version, expected_value=str(before))
+    if not ok and version is not None:
+        # the manual edit wins; apply this turn's change on top of it, once
+        try:
+            base = int(db_level)
+        except (TypeError, ValueError):
+            base = before
+        log.info(f"Level for user {user_id} changed elsewhere (v{s.level_version} -> v{version}, level {base})")
+        s.level = max(1, min(max_level, base + change))
+        ok, _, version = await cas_fact(user_id, "level", str(s.level), version, expected_value=str(base))
+
+    if version is not None:
+        s.level_version = version
 
     # boss trigger unchanged
-    if s["level"] % 5 == 0:
-        s["boss_active"] = True
-        s["boss_counter"] = 0
-
-    # persist with 1 retry
-    ok = update_fact(user_id, "level", str(s["level"]))
-    if not ok:
-        time.sleep(0.3)
-        ok = update_fact(user_id, "level", str(s["level"]))
-
-    # optional: read-after-write to keep USER_STATE == DB
-    if ok:
-        facts = load_facts(user_id)
-        if "level" in facts:
-            try:
-                db_level = int(facts["level"])
-                if db_level != s["level"]:
-                    log.warning(f"Supabase echoed different level for {user_id}: mem={s['level']} db={db_level}. Using db.")
-                    s["level"] = db_level
-            except ValueError:
-                pass
+    if s.level % 5 == 0:
+        s.boss_active = True
+        s.boss_counter = 0
 
-    log.info(f"Level change for user {user_id}: {before} + ({change}) -> {s['level']} (saved={ok})")
-    return s["level"]
+    log.info(f"Level change for user {user_id}: {before} + ({change}) -> {s.level} (saved={ok})")
+    return s.level
 
 def clamp_int(n: int, lo: int = 0, hi: int = 10) -> int:
     try:
@@ -425,17 +605,83 @@ No extra keys, no prose.
     """
 ).strip()
 
+pre_scorer = PreScorer.load(SCORER_WEIGHTS)
+if pre_scorer:
+    log.info(f"Local pre-scorer loaded from {SCORER_WEIGHTS} ({pre_scorer.meta})")
+scorer_log = ExampleLog(SCORER_LOG) if SCORER_LOG else None
+
+
+def prescore(user_message: str) -> Tuple[Optional[Prediction], bool]:
+    """(pre-scorer prediction or None, score locally?) - the LLM scorer runs unless the second is True."""
+    pred, local = None, False
+    if pre_scorer is not None:
+        pred, local = pre_scorer.decide(user_message)
+        # a few local decisions still go to the LLM, so agreement keeps being measured
+        if local and random.random() < SCORER_AUDIT_RATE:
+            local = False
 
-def score_message(last_bot: str, user_message: str) -> Tuple[int, int, str]:
+    metrics.SCORER_ROUTE.labels("local" if local else "llm").inc()
+    if local and scorer_log:
+        scorer_log.add(user_message, pred.flirty, pred.personality, "local", pred.p_trivial)
+    return pred, local
+
+
+def log_llm_score(user_message: str, flirty: int, personality: int, pred: Optional[Prediction]):
+    if scorer_log:
+        scorer_log.add(user_message, flirty, personality, "llm", pred.p_trivial if pred else None)
+
+
+async def openai_chat(call: str, plan: str = "starter", **kwargs):
+    """
+    Every chat completion goes through here, so each call type is timed and logged in one place.
+    `plan` sets the call's priority in the LLM scheduler (may raise LLMShed under load).
+    """
+    started = time.perf_counter()
+    estimated = sum(estimate_tokens(m.get("content") or "") for m in kwargs.get("messages", []))
+    estimated += kwargs.get("max_tokens") or LLM_DEFAULT_COMPLETION_TOKENS
+
+    async def create():
+        with metrics.OPENAI_SECONDS.labels(call).time():
+            return await client.chat.completions.create(**kwargs)
+
+    with tracing.span(f"openai.{call}", plan=plan):
+        resp = await llm.run(plan, estimated, call, create)
+
+    if not kwargs.get("stream"):
+        log_llm_usage(call, resp, started)
+        resp_usage = getattr(resp, "usage", None)
+        if resp_usage:
+            llm.settle(estimated, resp_usage.total_tokens)
+    return resp
+
+
+def log_llm_usage(kind: str, resp, started: float):
+    """Log latency + token usage per OpenAI call, so analysis modes can be compared."""
+    resp_usage = getattr(resp, "usage", None)
+    log.info(
+        f"OpenAI {kind}: {(time.perf_counter() - started) * 1000:.0f}ms "
+        f"prompt_tokens={getattr(resp_usage, 'prompt_tokens', '?')} "
+        f"completion_tokens={getattr(resp_usage, 'completion_tokens', '?')}"
+    )
+
+
+async def score_message(convo: str, user_message: str, plan: str = "starter") -> Tuple[int, int, str]:
     """Return (flirty, personality, raw_json) with robust parsing and fallback heuristics."""
+    pred, local = prescore(user_message)
+    if local:
+        return pred.flirty, pred.personality, pred.raw()
+
     user_prompt = (
-        f"Context from Sofia: \n{last_bot}\n\nUser reply: \n{user_message}\n\n"
+        f"Conversation so far: \n{convo}\n\nUser reply: \n{user_message}\n\n"
         "Rate strictly based on flirtiness and personality depth."
     )
 
     raw = "{}"
+    answered = False
     try:
-        resp = client.chat.completions.create(
+        resp = await openai_chat(
+            "scorer",
+            plan,
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": SCORER_SYSTEM},
@@ -446,9 +692,18 @@ def score_message(last_bot: str, user_message: str) -> Tuple[int, int, str]:
             response_format={"type": "json_object"},  # enforce JSON mode
         )
         raw = (resp.choices[0].message.content or "{}").strip()
+        answered = True
     except Exception as e:
         log.warning(f"OpenAI score error: {e}")
 
+    flirty, personality = parse_scores(raw, user_message)
+    if answered:
+        log_llm_score(user_message, flirty, personality, pred)
+    return flirty, personality, raw
+
+
+def parse_scores(raw: str, user_message: str) -> Tuple[int, int]:
+    """Pull (flirty, personality) out of scorer JSON, falling back to regex, then heuristics."""
     flirty = personality = None
 
     # Primary: JSON parse
@@ -463,11 +718,13 @@ def score_message(last_bot: str, user_message: str) -> Tuple[int, int, str]:
     if flirty is None or personality is None:
         m = re.search(r'"flirty"\s*:\s*(\d+).*?"personality"\s*:\s*(\d+)', raw, re.S)
         if m:
+            metrics.FALLBACKS.labels("score_regex").inc()
             flirty = clamp_int(m.group(1))
             personality = clamp_int(m.group(2))
 
     # Final fallback: lightweight heuristic (avoids constant 3/10)
     if flirty is None or personality is None:
+        metrics.FALLBACKS.labels("score_heuristic").inc()
         txt = user_message.lower()
         heur_flirt = 3
         heur_pers = 3
@@ -480,7 +737,7 @@ def score_message(last_bot: str, user_message: str) -> Tuple[int, int, str]:
         flirty = clamp_int(heur_flirt)
         personality = clamp_int(heur_pers)
 
-    return flirty, personality, raw
+    return flirty, personality
 
 
 def bucket_rating(difficulty: str, avg_score: float) -> Tuple[str, int]:
@@ -515,9 +772,11 @@ Rules:
 """
 
 
-def extract_facts(user_message: str) -> Dict[str, str]:
+async def extract_facts(user_message: str, plan: str = "starter") -> Dict[str, str]:
     try:
-        resp = client.chat.completions.create(
+        resp = await openai_chat(
+            "fact_extractor",
+            plan,
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": FACT_SYSTEM},
@@ -529,8 +788,16 @@ def extract_facts(user_message: str) -> Dict[str, str]:
         )
 
         raw = (resp.choices[0].message.content or "{}").strip()
-        data = json.loads(raw)
+        return parse_fact(json.loads(raw))
+
+    except Exception as e:
+        log.warning(f"extract_facts error: {e}")
+        return {}
 
+
+def parse_fact(data: Dict) -> Dict[str, str]:
+    """Validate an extracted {fact, value, confidence} object; returns {} if it doesn't pass."""
+    try:
         fact_key = (data.get("fact") or "").strip().lower()
         fact_value = (data.get("value") or "").strip()
         confidence = float(data.get("confidence") or 0.0)
@@ -557,40 +824,127 @@ def extract_facts(user_message: str) -> Dict[str, str]:
         return {fact_key: fact_value}
 
     except Exception as e:
-        log.warning(f"extract_facts error: {e}")
+        log.warning(f"parse_fact error: {e}")
         return {}
 
-def delete_fact(user_id: int, key: str) -> bool:
-    try:
-        payload = {
-            "action": "delete",
-            "user_id": str(user_id),
-            "key": key
-        }
-        resp = requests.post(
-            SUPABASE_EDGE_URL,
-            headers={
-                "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-                "apikey": SUPABASE_ANON_KEY,
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=8,
+# =============================
+# Conversation history (token-bounded + rolling summary)
+# =============================
+
+SUMMARY_SYSTEM = (
+    """
+You keep a running summary of a chat between a user and Sofia.
+Merge the previous summary with the new turns into ONE summary of at most 80 words.
+Keep what matters for the next replies: topics, plans, inside jokes, how the user has been acting.
+Plain text only, no lists.
+    """
+).strip()
+
+
+async def summarize_history(summary: str, turns) -> str:
+    names = {"user": "User", "assistant": "Sofia"}
+    transcript = "\n".join(f"{names.get(role, role)}: {text}" for role, text, _ in turns)
+
+    # nobody is waiting on a summary, so it yields to live turns
+    resp = await openai_chat(
+        "summarizer",
+        "background",
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM},
+            {"role": "user", "content": f"Previous summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+        ],
+        temperature=0.0,
+        max_tokens=160,
+    )
+    return resp.choices[0].message.content or ""
+
+# =============================
+# Turn analysis (score + fact in one call)
+# =============================
+
+# "split" = separate scorer + extractor calls, "fused" = one combined call
+TURN_ANALYSIS_MODE = os.getenv("TURN_ANALYSIS_MODE", "split").lower()
+
+ANALYSIS_SYSTEM = (
+    """
+You are a strict evaluator and fact extractor. Return ONLY valid JSON:
+{"flirty": 0-10, "personality": 0-10, "rationale": "<max 20 words>",
+ "fact": "<field>", "value": "<string>", "confidence": 0.0-1.0}
+
+Scoring: rate the user reply strictly based on flirtiness and personality depth (integers).
+
+Fact: extract at most ONE factual user detail from the user reply.
+ONLY stable personal info (age, city, country, school, job, interests, favorite_food, favorite_hobby, relationship_goal, personality).
+- If no fact exists: "fact": "", "value": "", "confidence": 0.0
+- Confidence must reflect how certain you are that this is true (not a guess).
+- Do NOT extract temporary emotions, money goals, jokes, or vague statements.
+- NEVER output more than one fact.
+No extra keys, no prose.
+    """
+).strip()
+
+
+async def analyze_turn(convo: str, user_message: str, plan: str = "starter") -> Tuple[int, int, str, Dict[str, str]]:
+    """Return (flirty, personality, raw_json, facts_found) using the configured analysis mode."""
+    if TURN_ANALYSIS_MODE != "fused":
+        (flirty, personality, raw), facts_found = await asyncio.gather(
+            score_message(convo, user_message, plan),
+            extract_facts(user_message, plan),
         )
+        return flirty, personality, raw, facts_found
+
+    pred, local = prescore(user_message)
+    if local:
+        # the scoring half of the fused call isn't needed; facts still come from the LLM
+        return pred.flirty, pred.personality, pred.raw(), await extract_facts(user_message, plan)
 
-        log.info(f"delete_fact({user_id}, {key}) -> {resp.status_code} {resp.text}")
-        return resp.ok
+    user_prompt = (
+        f"Conversation so far: \n{convo}\n\nUser reply: \n{user_message}\n\n"
+        "Rate strictly based on flirtiness and personality depth, and extract at most one fact from the user reply."
+    )
 
+    raw = "{}"
+    answered = False
+    try:
+        resp = await openai_chat(
+            "turn_analysis",
+            plan,
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": ANALYSIS_SYSTEM},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=0.0,
+            max_tokens=160,
+            response_format={"type": "json_object"},
+        )
+        raw = (resp.choices[0].message.content or "{}").strip()
+        answered = True
     except Exception as e:
-        log.exception(f"delete_fact error: {e}")
-        return False
+        log.warning(f"OpenAI turn analysis error: {e}")
+
+    flirty, personality = parse_scores(raw, user_message)
+    if answered:
+        log_llm_score(user_message, flirty, personality, pred)
+
+    facts_found = {}
+    try:
+        data = json.loads(raw)
+        if isinstance(data, dict):
+            facts_found = parse_fact(data)
+    except Exception:
+        pass
+
+    return flirty, personality, raw, facts_found
+
+MOOD_CHOICES = [
+    ["great", "good", "fine"],
+    ["tired", "stressed", "sad", "angry"]
+]
 
 def mood_keyboard() -> ReplyKeyboardMarkup:
-    keyboard = [
-        ["great", "good", "fine"],
-        ["tired", "stressed", "sad", "angry"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return ReplyKeyboardMarkup(MOOD_CHOICES, resize_keyboard=True)
 
 # =============================
 # Telegram Handlers
@@ -604,24 +958,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    if user_id not in AUTHORIZED_USERS:
+    if not await is_authorized(user_id):
         await update.message.reply_text("🔒 please unlock first by sending the password.")
         return
-    s = get_user_state(user_id)
+    s = await get_user_state(user_id)
     await update.message.reply_text(
-        f"current difficulty: {s['difficulty']}. choose one:", reply_markup=difficulty_keyboard()
+        f"current difficulty: {s.difficulty}. choose one:", reply_markup=difficulty_keyboard()
     )
 
 
 async def show_rating_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s = get_user_state(update.message.from_user.id)
-    s["show_rating"] = True
+    user_id = update.message.from_user.id
+    if not await is_authorized(user_id):
+        await update.message.reply_text("🔒 please unlock first by sending the password.")
+        return
+    s = await get_user_state(user_id)
+    s.show_rating = True
     await update.message.reply_text("✅ rating display is now ON")
 
 
 async def set_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    if user_id not in DEV_USERS:
+    if not is_dev(user_id):
         await update.message.reply_text("⛔ You don't have access to this command.")
         return
 
@@ -631,11 +989,13 @@ async def set_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Usage: /setlevel <number>")
         return
 
-    s = get_user_state(user_id)
-    s["level"] = level
+    s = await get_user_state(user_id)
+    s.level = level
 
-    # ✅ persist level in Supabase
-    update_fact(user_id, "level", str(level))
+    # ✅ persist level in Supabase; the version bump tells other sessions it was set by hand
+    _, _, version = await cas_fact(user_id, "level", str(level), s.level_version, force=True)
+    if version is not None:
+        s.level_version = version
 
     await update.message.reply_text(f"🧪 Level manually set to {level}")
 
@@ -644,36 +1004,45 @@ async def reload_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
     # make sure only devs can use this
-    if user_id not in DEV_USERS:
+    if not is_dev(user_id):
         await update.message.reply_text("⛔ You don't have access to this command.")
         return
 
-    s = get_user_state(user_id)
-    facts = load_facts(user_id)
+    s = await get_user_state(user_id)
+    facts = await load_facts(user_id, fresh=True)
+    entitlements.invalidate(user_id)
 
     # ✅ Reload level from Supabase if it exists
     if "level" in facts:
         try:
-            s["level"] = int(facts["level"])
+            s.level = int(facts["level"])
+            s.level_version = int(facts.get("level_version") or 0)
         except ValueError:
             pass
 
     # ✅ Reload difficulty too if it's stored
     if "difficulty" in facts:
-        s["difficulty"] = facts["difficulty"]
+        s.difficulty = facts["difficulty"]
 
     await update.message.reply_text(
-        f"🔄 Reloaded state from Supabase:\n{json.dumps(s, indent=2)}"
+        f"🔄 Reloaded state from Supabase:\n{json.dumps(s.as_dict(), indent=2)}"
     )
 
 async def hide_rating_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s = get_user_state(update.message.from_user.id)
-    s["show_rating"] = False
+    user_id = update.message.from_user.id
+    if not await is_authorized(user_id):
+        await update.message.reply_text("🔒 please unlock first by sending the password.")
+        return
+    s = await get_user_state(user_id)
+    s.show_rating = False
     await update.message.reply_text("❌ rating display is now OFF")
 
 
 async def remember_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
+    if not await is_authorized(user_id):
+        await update.message.reply_text("🔒 please unlock first by sending the password.")
+        return
     try:
         key, value = context.args[0], " ".join(context.args[1:]).strip()
         if not value:
@@ -682,8 +1051,13 @@ async def remember_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ usage: /remember <key> <value>")
         return
 
-    plan, _ = get_plan_and_usage(user_id)
-    current = get_memory_count(user_id)
+    # plan, usage, auth etc. are only written by the bot itself
+    if key.lower() in PROTECTED_FACTS | INTERNAL_FACT_KEYS:
+        await update.message.reply_text(f"⛔ {key} can't be set with /remember.")
+        return
+
+    plan, _ = await get_plan_and_usage(user_id)
+    current = await get_memory_count(user_id)
     limit = MEMORY_LIMITS.get(plan, 10)
 
     if current >= limit:
@@ -693,15 +1067,14 @@ async def remember_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    update_fact(user_id, key, value)
-    set_memory_count(user_id, current + 1)
+    await update_facts(user_id, {key: value, "memory_count": str(current + 1)})
 
     await update.message.reply_text(f"✅ remembered: {key} = {value}")
 
 
 async def showmemory_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    facts = load_facts(user_id)
+    facts = await load_facts(user_id)
     if not facts:
         await update.message.reply_text("ℹ️ no facts saved yet.")
     else:
@@ -712,27 +1085,28 @@ async def account_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
     # must be unlocked
-    if user_id not in AUTHORIZED_USERS:
+    if not await is_authorized(user_id):
         await update.message.reply_text("🔒 please unlock first by sending the password.")
         return
 
     # Load plan + usage
-    plan, used = get_plan_and_usage(user_id)
+    plan, used = await get_plan_and_usage(user_id)
 
     # Load memory stats + email + activation date
-    facts = load_facts(user_id)
+    facts = await load_facts(user_id)
     memory_used = int(facts.get("memory_count", "0"))
     memory_limit = MEMORY_LIMITS.get(plan, 10)
     memory_left = max(0, memory_limit - memory_used)
 
     email = facts.get("email", "unknown")
     activation_date = facts.get("activation_date", "unknown")
+    used_text = f"{used}/{STARTER_LIMIT}" if plan == "starter" else "unlimited"
 
     # Pretty UI block
     text = (
         f"📊 *Your Account Overview*\n\n"
         f"💼 *Plan:* {plan}\n"
-        f"💬 *Messages Used:* {used}\n"
+        f"💬 *Messages Used:* {used_text}\n"
         f"🧠 *Memory:* {memory_used}/{memory_limit} (left: {memory_left})\n"
         f"📧 *Email:* {email}\n"
         f"⏳ *Activation Date:* {activation_date}\n\n"
@@ -754,13 +1128,17 @@ PROTECTED_FACTS = {
     "telegram_id",
     "difficulty",
     "level",
+    "level_version",
     "activation_date",
+    "timezone",
+    "reminded_on",
+    AUTHORIZED_FACT,
 }
 
 async def resetmemory_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if user_id not in AUTHORIZED_USERS:
+    if not await is_authorized(user_id):
         await update.message.reply_text("🔒 please unlock first by sending the password.")
         return
 
@@ -789,48 +1167,25 @@ async def resetmemory_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
     if data == "reset_memory_confirm":
         # load all facts
-        facts = load_facts(user_id)
+        facts = await load_facts(user_id)
 
-        # delete each fact except protected ones
-        for key in facts.keys():
-            if key not in PROTECTED_FACTS:
-                delete_fact(user_id, key)
+        # delete every fact except protected ones in one round-trip
+        await delete_facts(user_id, [k for k in facts.keys() if k not in PROTECTED_FACTS and k != "memory_count"])
 
         # reset counter
-        set_memory_count(user_id, 0)
+        await set_memory_count(user_id, 0)
 
         await update.callback_query.edit_message_text("🧠 Memory successfully reset!")
 
 
-async def send_typing(update: Update, min_delay=1, max_delay=3):
-    chat_id = update.message.chat_id
-    delay = random.uniform(min_delay, max_delay)
-
-    try:
-        await update.get_bot().send_chat_action(chat_id, "typing")
-    except:
-        pass
-
-    await asyncio.sleep(delay)
-
 # =============================
 # Chat Handler (includes Chad Coach Mode) 
 # =============================
 
-def refresh_level_from_supabase(user_id: int):
-    facts = load_facts(user_id)
-    if "level" in facts:
-        try:
-            level_from_db = int(facts["level"])
-            s = get_user_state(user_id)
-            s["level"] = level_from_db
-        except ValueError:
-            pass
-
 async def mood_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if user_id not in AUTHORIZED_USERS:
+    if not await is_authorized(user_id):
         await update.message.reply_text("🔒 please unlock first by sending the password.")
         return
 
@@ -841,25 +1196,120 @@ async def mood_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     context.user_data["awaiting_mood"] = True
 
+async def timezone_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/timezone Europe/Berlin — when the daily mood reminder should arrive."""
+    user_id = update.message.from_user.id
+    if not await is_authorized(user_id):
+        await update.message.reply_text("🔒 please unlock first by sending the password.")
+        return
+    s = await get_user_state(user_id)
+
+    if not context.args:
+        await update.message.reply_text(
+            f"🕒 your timezone: {s.timezone or MOOD_REMINDER_TZ}\n"
+            "change it with /timezone <Region/City>, e.g. /timezone Europe/Berlin"
+        )
+        return
+
+    name = context.args[0]
+    if name not in pytz.all_timezones_set:
+        await update.message.reply_text("❌ unknown timezone. use a name like Europe/Berlin or America/New_York.")
+        return
+
+    s.timezone = name
+    await update_fact(user_id, "timezone", name)
+    await update.message.reply_text(f"✅ timezone set to {name}. i'll check on you around {MOOD_REMINDER_HOUR}:00.")
+
+def mood_reminder_due(timezone: Optional[str], reminded_on: Optional[str], now_utc: datetime) -> Optional[str]:
+    """The user's local date if the reminder is due now (once per local day, inside the window), else None."""
+    tz = pytz.timezone(timezone if timezone in pytz.all_timezones_set else MOOD_REMINDER_TZ)
+    local = now_utc.astimezone(tz)
+    if not MOOD_REMINDER_HOUR <= local.hour < MOOD_REMINDER_HOUR + MOOD_REMINDER_WINDOW:
+        return None
+    today = local.date().isoformat()
+    return today if reminded_on != today else None
+
+# user_id -> {"timezone", "reminded_on"}, from the last full scan plus local changes since
+_mood_roster: Dict[int, Dict[str, str]] = {}
+_mood_roster_loaded_at: Optional[float] = None
+
+async def mood_reminder_recipients() -> Dict[int, Dict[str, str]]:
+    """
+    Activated users (a `plan` fact) with their timezone/reminded_on facts.
+    Read from Supabase every MOOD_ROSTER_TTL; in between, only live
+    sessions (new activations, /timezone changes) are merged in.
+    """
+    global _mood_roster_loaded_at
+    now = time.monotonic()
+    if _mood_roster_loaded_at is None or now - _mood_roster_loaded_at > MOOD_ROSTER_TTL:
+        users = await scan_users("plan", ["timezone", "reminded_on"])
+        if users is not None:
+            _mood_roster.clear()
+            _mood_roster.update(users)
+            _mood_roster_loaded_at = now
+        elif _mood_roster_loaded_at is None:
+            log.warning("Mood reminder: user scan unavailable, only reaching sessions in memory")
+
+    # live sessions may know more than the facts (e.g. a marker write that failed)
+    for s in SESSIONS.authorized_sessions():
+        facts = _mood_roster.setdefault(s.user_id, {})
+        if s.timezone:
+            facts["timezone"] = s.timezone
+        if s.reminded_on and s.reminded_on > facts.get("reminded_on", ""):
+            facts["reminded_on"] = s.reminded_on
+    return _mood_roster
+
+# a full broadcast can outlast MOOD_REMINDER_TICK; don't start a second one meanwhile
+_mood_reminder_lock = asyncio.Lock()
+
 async def daily_mood_reminder(context):
-    for user_id in AUTHORIZED_USERS:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="hey, how are you feeling today?\ntell me using /mood"
-            )
-        except:
-            pass
+    """Runs every MOOD_REMINDER_TICK; broadcasts to users whose local reminder time has come."""
+    if _mood_reminder_lock.locked():
+        return
 
-async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    user_message = (update.message.text or "").strip()
+    async with _mood_reminder_lock:
+        now_utc = datetime.now(pytz.utc)
+        due: Dict[int, str] = {}
+        for user_id, facts in (await mood_reminder_recipients()).items():
+            today = mood_reminder_due(facts.get("timezone"), facts.get("reminded_on"), now_utc)
+            if today:
+                due[user_id] = today
+
+        if not due:
+            return
+
+        # mark first (in Supabase and live sessions), so no later run picks the same users again
+        for user_id, today in due.items():
+            _mood_roster.setdefault(user_id, {})["reminded_on"] = today
+            s = SESSIONS.peek(user_id)
+            if s is not None:
+                s.reminded_on = today
+        await set_fact_for_users("reminded_on", due)
+
+        broadcaster: Broadcaster = context.application.bot_data["broadcaster"]
+        result = await broadcaster.send_all(list(due), "hey, how are you feeling today?\ntell me using /mood")
+        context.application.bot_data["last_mood_broadcast"] = result.as_dict()
+        log.info(f"Mood reminder: {len(due)} due, {result}")
 
-    if not user_message:
+async def sweep_sessions(context):
+    dropped = SESSIONS.sweep()
+    if dropped:
+        log.info(f"Evicted {dropped} idle sessions ({len(SESSIONS)} active)")
+
+async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not (update.message.text or "").strip():
         return
 
-    # typing animation before ANY reply logic
-    await send_typing(update)
+    # typing animation runs in the background for the whole turn,
+    # overlapping scoring + generation instead of sleeping up front
+    # one trace per update; spans below (and in supabase_client/pacing) attach to it
+    with metrics.CHAT_TURN_SECONDS.time(), tracing.trace("chat", update.message.from_user.id, update_id=update.update_id):
+        async with ReplyPacer(update.get_bot(), update.message.chat_id) as pacer:
+            await chat_turn(update, context, pacer)
+
+async def chat_turn(update: Update, context: ContextTypes.DEFAULT_TYPE, pacer: ReplyPacer):
+    user_id = update.message.from_user.id
+    user_message = (update.message.text or "").strip()
 
     if user_message.lower() == "ping":
         return
@@ -867,19 +1317,20 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Developer mode password check
     if context.user_data.get("awaiting_dev_password"):
         context.user_data["awaiting_dev_password"] = False
-        if user_message == DEV_PASSWORD:
-            DEV_USERS.add(user_id)
+        if user_message == DEV_PASSWORD and await is_authorized(user_id):
+            (await get_user_state(user_id)).dev = True
             await update.message.reply_text("✅ Dev mode activated!")
         else:
             await update.message.reply_text("❌ Wrong password.")
         return
 
     # password gate
-    if user_id not in AUTHORIZED_USERS:
+    if not await is_authorized(user_id):
     
         # user enters the bot password
         if user_message == BOT_PASSWORD:
-            AUTHORIZED_USERS.add(user_id)
+            (await get_user_state(user_id)).authorized = True
+            await update_facts(user_id, {AUTHORIZED_FACT: "1"})
     
             await update.message.reply_text(
                 "🔑 Perfect. What email did you use when buying the product?"
@@ -896,7 +1347,7 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["awaiting_email"] = False
     
         email = user_message.strip().lower()
-        record = fetch_user_plan(email)
+        record = await fetch_user_plan(email)
     
         if not record:
             await update.message.reply_text("❌ Email not found. Try again.")
@@ -912,28 +1363,40 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
         # claim ownership (first activation)
-        set_email_owner(email, user_id)
+        await set_email_owner(email, user_id)
     
         plan = record["plan"]
     
-        update_fact(user_id, "plan", plan)
-        update_fact(user_id, "messages_used", "0")
-        set_memory_count(user_id, 0)
-
-        # 🔐 Store email + activation date in facts for /account
-        update_fact(user_id, "email", email)
-        update_fact(user_id, "activation_date", time.strftime("%Y-%m-%d"))
+        usage.discard(user_id)
+        await update_facts(user_id, {
+            "plan": plan,
+            "messages_used": "0",
+            "memory_count": "0",
+            # 🔐 Store email + activation date in facts for /account
+            "email": email,
+            "activation_date": time.strftime("%Y-%m-%d"),
+        })
+        entitlements.update(user_id, plan, email=email, owner=user_id)
     
         await update.message.reply_text(f"✅ Plan activated: {plan}")
         return
+
+    # 😊 answer to /mood (read back by the mood logic below for 24h)
+    if context.user_data.get("awaiting_mood"):
+        context.user_data["awaiting_mood"] = False
+        mood = user_message.lower()
+        if any(mood in row for row in MOOD_CHOICES):
+            await update_facts(user_id, {"mood": mood, "mood_timestamp": str(int(time.time()))})
+            await update.message.reply_text("got it. thanks for telling me.", reply_markup=ReplyKeyboardRemove())
+            return
        
     # state
-    s = get_user_state(user_id)
-    # 🔄 Sync the level with Supabase to make sure we don't overwrite manual edits
-    refresh_level_from_supabase(user_id)
+    with tracing.span("state"):
+        # manual level edits are caught by the level_version check in apply_level_change
+        s = await get_user_state(user_id)
 
-    # 🔐 Load plan + usage
-    plan, used = get_plan_and_usage(user_id)
+        # 🔐 Load plan + usage
+        plan, used = await get_plan_and_usage(user_id)
     # keep in context so we can use at the end
     context.user_data["plan"] = plan
     context.user_data["messages_used"] = used
@@ -951,12 +1414,12 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # quick difficulty selection
     if user_message in DIFFICULTY_MAP:
-        s["difficulty"] = DIFFICULTY_MAP[user_message]
+        s.difficulty = DIFFICULTY_MAP[user_message]
         await update.message.reply_text(
-            f"🎭 difficulty set to {s['difficulty']}", reply_markup=difficulty_keyboard()
+            f"🎭 difficulty set to {s.difficulty}", reply_markup=difficulty_keyboard()
         )
         return
-    difficulty = s["difficulty"]
+    difficulty = s.difficulty
     max_level = DIFFICULTY_MAX_LEVEL.get(difficulty, 50)
 
     # ========== CHAD COACH MODE (Step 1 & 2 & 4) ==========
@@ -964,112 +1427,111 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Always define a default value
         coach_prompt = PROMPTS["coach"]
         coach_text = ""  # <— define variable up front
-    
-        try:
-            resp = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": coach_prompt},
-                    {"role": "user", "content": user_message},
-                ],
-                temperature=0.8,
-                max_tokens=500  # 5000 is unnecessary; 500–800 is plenty
-            )
-            coach_text = (resp.choices[0].message.content or "").strip()
-            coach_text = re.sub(r'[*_~`]', '', coach_text)
-    
-        except Exception as e:
-            log.error(f"OpenAI coach error: {e}")
-        s["last_bot_message"] = coach_text
+
+        # ♻️ Same question asked before? answer from cache
+        if COACH_CACHE:
+            coach_text = coach_cache.get(user_message) or ""
+
+        if not coach_text:
+            try:
+                resp = await openai_chat(
+                    "coach",
+                    plan,
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": coach_prompt},
+                        {"role": "user", "content": user_message},
+                    ],
+                    temperature=0.8,
+                    max_tokens=500  # 5000 is unnecessary; 500–800 is plenty
+                )
+                coach_text = (resp.choices[0].message.content or "").strip()
+                coach_text = re.sub(r'[*_~`]', '', coach_text)
+
+                if COACH_CACHE and coach_text:
+                    coach_cache.put(user_message, coach_text)
+
+            except Exception as e:
+                log.error(f"OpenAI coach error: {e}")
 
         # 🔢 Count this as a used message for Starter plan
         plan = context.user_data.get("plan", "starter")
         used = context.user_data.get("messages_used", 0)
-        new_used = increment_usage_if_needed(user_id, plan, used)
+        new_used = await increment_usage_if_needed(user_id, plan, used)
         context.user_data["messages_used"] = new_used
     
         # 🛡️ Guard against empty responses
         if not coach_text:
             log.warning("Coach mode returned empty response.")
+            metrics.FALLBACKS.labels("coach_empty").inc()
             return
     
         # Split and send messages naturally
-        parts = re.split(r'(?<=[.!?])\s+', coach_text)
-        sent = 0
-        for p in parts:
-            chunk = p.strip()
-            if chunk:
-                await send_typing(update)
-                await update.message.reply_text(chunk)
-                sent += 1
-                if sent >= 100:
-                    break
-    
-        s["last_bot_message"] = coach_text
+        await send_split_message(update, coach_text, pacer, max_parts=100)
         return
 
     # ===== Non-coach flow (unchanged): scoring, memory, reply =====
 
-    # 1) scoring (robust)
-    flirty, personality, raw_json = score_message(s.get("last_bot_message", ""), user_message)
+    # 1) scoring (robust) + fact extraction, split or fused per TURN_ANALYSIS_MODE
+    history = s.history
+    convo = history.transcript() or f"Sofia: {s.last_bot_message}"
+    with tracing.span("analysis", mode=TURN_ANALYSIS_MODE):
+        flirty, personality, raw_json, facts_found = await analyze_turn(convo, user_message, plan)
     avg_score = (flirty + personality) / 2.0
     rating, delta = bucket_rating(difficulty, avg_score)
-    new_level = apply_level_change(user_id, delta, max_level)
+    with tracing.span("level_change"):
+        new_level = await apply_level_change(user_id, delta, max_level)
 
     # 2) auto fact extraction (save if any)
-    facts_found = extract_facts(user_message)
     if facts_found:
-        plan, _ = get_plan_and_usage(user_id)
-        current_count = get_memory_count(user_id)
+        plan, _ = await get_plan_and_usage(user_id)
+        current_count = await get_memory_count(user_id)
         limit = MEMORY_LIMITS.get(plan, 10)
     
+        to_save = {}
         for k, v in facts_found.items():
             if current_count >= limit:
                 log.info(f"User {user_id} memory FULL for plan {plan}.")
                 break
     
-            update_fact(user_id, k, v)
+            to_save[k] = v
             current_count += 1
-            set_memory_count(user_id, current_count)
+
+        if to_save:
+            to_save["memory_count"] = str(current_count)
+            with tracing.span("save_facts", count=len(to_save) - 1):
+                await update_facts(user_id, to_save)
 
 
     # 3) build reply system prompt
-    sys_prompt = PROMPTS.get(difficulty, PROMPTS["medium"]).strip()
+    # static persona + mode blocks go before the history, per-turn data after it (keeps the prefix cacheable)
+    prompt = PromptBuilder()
+    prompt.static("persona", PROMPTS.get(difficulty, PROMPTS["medium"]))
 
     # 🔥 Spicy Mode for Hard difficulty (Level 75+)
-    if difficulty == "hard" and s["level"] >= 75:
-        sys_prompt += """
-        
-    SPICY_MODE:
-    - Speak in a seductive, suggestive, and playful tone.
-    - Lean into sexual tension and flirty innuendo.
-    - If the user flirts directly or says something bold (e.g. "I want to be in bed with you"),
-      flirt back instead of deflecting or acting shy.
-    - Ask teasing questions like "oh really? what would you do if you were here right now?".
-    - Be more direct, confident, and playful than normal.
-    - Avoid neutral replies like "that's bold".
-    - Never describe explicit sexual acts. Stay suggestive, not graphic.
-    """
-
-    # 🧠 Optional: detect bold / sexual messages to push spiciness further
-    lower_msg = user_message.lower()
-    if difficulty == "hard" and s["level"] >= 75:
-        if any(phrase in lower_msg for phrase in ["in bed", "kiss you", "touch you", "your lips", "your body", "on top of you"]):
-            sys_prompt += "\nThe user is flirting boldly. Respond playfully and seductively, as if teasing them back."
-
-    
-    if s.get("boss_active"):
-        sys_prompt += "\nBOSS_MODE: be cold, short, and dismissive for ~5 replies."
-        s["boss_counter"] += 1
-        if s["boss_counter"] >= 5:
-            s["boss_active"] = False
-
-    # inject facts
-    known = load_facts(user_id)
-    if known:
-        lines = [f"- {k}: {v}" for k, v in known.items()]
-        sys_prompt += "\n\n# Known facts about this user:\n" + "\n".join(lines)
-        # ------- MOOD LOGIC -------
+    spicy = difficulty == "hard" and s.level >= 75
+    if spicy:
+        prompt.static("spicy_mode", SPICY_MODE_PROMPT)
+
+    if s.boss_active:
+        prompt.static("boss_mode", BOSS_MODE_PROMPT)
+        s.boss_counter += 1
+        if s.boss_counter >= 5:
+            s.boss_active = False
+
+    # older turns that rolled out of the history buffer
+    if history.summary:
+        prompt.dynamic("summary", "# Earlier in this conversation:\n" + history.summary)
+
+    # inject the facts most relevant to this message, within FACT_TOKEN_BUDGET
+    with tracing.span("load_facts"):
+        known = await load_facts(user_id)
+    relevant = select_facts(known, user_message, FACT_TOKEN_BUDGET)
+    if relevant:
+        lines = [f"- {k}: {v}" for k, v in relevant]
+        prompt.dynamic("facts", "# Known facts about this user:\n" + "\n".join(lines))
+
+    # ------- MOOD LOGIC -------
     mood = known.get("mood")
     mood_time = known.get("mood_timestamp")
 
@@ -1081,77 +1543,145 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # mood older than 24h → delete it
         if mood_age > 86400:
-            update_fact(user_id, "mood", "")
+            await update_fact(user_id, "mood", "")
         else:
             if mood in ["tired", "stressed", "sad", "angry"]:
-                sys_prompt += "\n\n# User Mood: The user feels bad today. Be warmer, softer, more supportive."
+                prompt.dynamic("mood", "# User Mood: The user feels bad today. Be warmer, softer, more supportive.")
             elif mood in ["great", "good", "fine"]:
-                sys_prompt += "\n\n# User Mood: The user feels good today. Be more playful, teasing, energetic."
+                prompt.dynamic("mood", "# User Mood: The user feels good today. Be more playful, teasing, energetic.")
 
+    # 🧠 Optional: detect bold / sexual messages to push spiciness further
+    lower_msg = user_message.lower()
+    if spicy and any(phrase in lower_msg for phrase in BOLD_FLIRT_PHRASES):
+        prompt.dynamic("bold_flirt", "The user is flirting boldly. Respond playfully and seductively, as if teasing them back.")
 
     # give the assistant awareness of rating so it can adapt warmth
-    sys_prompt += (
-        f"\n\n# Rating context for current user message:\n"
+    prompt.dynamic(
+        "rating",
+        f"# Rating context for current user message:\n"
         f"flirty={flirty}/10, personality={personality}/10, average={avg_score:.1f} -> {rating}\n"
-        f"Adapt tone accordingly (warmer for excellent, neutral for good, cooler for bad)."
+        f"Adapt tone accordingly (warmer for excellent, neutral for good, cooler for bad).",
     )
 
-    # 4) generate reply
-    reply_text = ""
-    try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": sys_prompt},
-                {"role": "user", "content": user_message},
-            ],
-            temperature=0.7,
-        )
-        reply_text = (resp.choices[0].message.content or "").strip()
-    except Exception as e:
-        log.error(f"OpenAI reply error: {e}")
-        reply_text = "hmm. say that again, but clearer."
-
-    # 5) send reply
-    await send_split_message(update, reply_text, 2, 5)
+    log.info(
+        f"Reply prompt for user {user_id}: {prompt.report()} "
+        f"history={history.tokens}t user_message={estimate_tokens(user_message)}t"
+    )
 
-    # persist last bot message for next scoring context
-    s["last_bot_message"] = reply_text
+    # 4) generate + 5) send reply
+    # persona, then history, then this turn's context: the prefix only grows turn to turn
+    reply_messages = prompt.messages(history.messages(), user_message)
+
+    with tracing.span("reply", streamed=bool(STREAM_REPLIES)):
+        if STREAM_REPLIES:
+            reply_text = await send_streamed_message(
+                update,
+                openai_chat(
+                    "reply",
+                    plan,
+                    model="gpt-4o-mini",
+                    messages=reply_messages,
+                    temperature=0.7,
+                    stream=True,
+                ),
+                pacer,
+            )
+        else:
+            reply_text = ""
+            try:
+                resp = await openai_chat(
+                    "reply",
+                    plan,
+                    model="gpt-4o-mini",
+                    messages=reply_messages,
+                    temperature=0.7,
+                )
+                reply_text = (resp.choices[0].message.content or "").strip()
+            except Exception as e:
+                log.error(f"OpenAI reply error: {e}")
+                reply_text = REPLY_FALLBACK
+
+            await send_split_message(update, reply_text, pacer)
+
+    # remember the exchange (also the scoring context for the next turn);
+    # overflow gets summarized off the reply path
+    history.add("user", user_message)
+    if reply_text != REPLY_FALLBACK:
+        history.add("assistant", reply_text)
+    else:
+        metrics.FALLBACKS.labels("reply").inc()
+    history.maybe_summarize(summarize_history)
 
     # optional rating display
-    if s.get("show_rating", False):
+    if s.show_rating:
         await update.message.reply_text(
             f"(rating: {rating} — flirty {flirty}/10, personality {personality}/10. level {new_level}/{max_level})"
         )
     # 🔢 Update usage for Starter plan (only after a successful reply)
     plan = context.user_data.get("plan", "starter")
     used = context.user_data.get("messages_used", 0)
-    new_used = increment_usage_if_needed(user_id, plan, used)
+    new_used = await increment_usage_if_needed(user_id, plan, used)
     context.user_data["messages_used"] = new_used
 
 # =============================
 # Bootstrap & Run
 # =============================
 
-def run_flask():
-    port = int(os.environ.get("PORT", 10000))
-    # threaded=False to keep it lean; debug=False for production
-    flask_app.run(host="0.0.0.0", port=port, debug=False, threaded=False)
-
 async def devmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
+    if not await is_authorized(user_id):
+        await update.message.reply_text("🔒 please unlock first by sending the password.")
+        return
 
-    if user_id in DEV_USERS:
+    if is_dev(user_id):
         await update.message.reply_text("🧪 Developer mode already active.")
         return
 
     await update.message.reply_text("🔑 Enter dev password:")
     context.user_data["awaiting_dev_password"] = True
 
+async def coach_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+
+    if not is_dev(user_id):
+        await update.message.reply_text("⛔ You don't have access to this command.")
+        return
+
+    stats = coach_cache.stats()
+    await update.message.reply_text(
+        f"♻️ Coach cache ({'on' if COACH_CACHE else 'off'}): "
+        f"{stats['size']} questions, {stats['hits']} hits, {stats['misses']} misses "
+        f"({stats['hit_rate']:.0%} hit rate)"
+    )
+
+async def traces_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/traces [user_id] — stage breakdown of the last few chat turns (dev only)."""
+    user_id = update.message.from_user.id
+
+    if not is_dev(user_id):
+        await update.message.reply_text("⛔ You don't have access to this command.")
+        return
+
+    target = user_id
+    if context.args:
+        try:
+            target = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Usage: /traces [user_id]")
+            return
+
+    recent = tracing.recent_traces(target)
+    if not recent:
+        await update.message.reply_text(f"No traces for {target} yet.")
+        return
+
+    text = "\n\n".join(tracing.breakdown(t) for t in recent[-3:])
+    await update.message.reply_text(f"🔎 Last turns for {target}:\n\n{text}"[:4000])
+
 async def set_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if user_id not in DEV_USERS:
+    if not is_dev(user_id):
         await update.message.reply_text("⛔ You don't have access to this command.")
         return
 
@@ -1165,10 +1695,13 @@ async def set_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Plan must be starter, pro, or elite.")
         return
 
-    update_fact(user_id, "plan", plan)
+    new_facts = {"plan": plan}
     # optional: reset usage when changing plan
     if plan == "starter":
-        update_fact(user_id, "messages_used", "0")
+        new_facts["messages_used"] = "0"
+        usage.discard(user_id)
+    await update_facts(user_id, new_facts)
+    entitlements.update(user_id, plan)
 
     await update.message.reply_text(f"✅ Plan set to: {plan}")
 
@@ -1182,38 +1715,101 @@ async def activate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # load customer info
-    resp = requests.post(
-        SUPABASE_EDGE_URL,
-        headers={ "Authorization": f"Bearer {SUPABASE_ANON_KEY}", "apikey": SUPABASE_ANON_KEY },
-        json={ "action": "get_plan_by_email", "email": email },
-        timeout=8
-    )
+    plan = await get_plan_by_email(email)
 
-    if not resp.ok:
+    if plan is None:
         await update.message.reply_text("❌ Email not found. Make sure you used the same email from Sellfy.")
         return
 
-    plan = resp.json().get("plan")
-
     if plan not in ["starter","pro","elite"]:
         await update.message.reply_text("❌ Invalid plan for this email.")
         return
 
     # save plan in user memory
-    update_fact(user_id, "plan", plan)
+    new_facts = {"plan": plan}
 
     # reset usage for starter (optional)
     if plan == "starter":
-        update_fact(user_id, "messages_used", "0")
+        new_facts["messages_used"] = "0"
+        usage.discard(user_id)
+    await update_facts(user_id, new_facts)
+    entitlements.update(user_id, plan, email=email)
 
     await update.message.reply_text(f"✅ Your plan has been activated: {plan.upper()}")
 
-def main():
-    # keep-alive server (Render health checks)
-    threading.Thread(target=run_flask, daemon=True).start()
+async def save_sessions_snapshot(context=None):
+    # copy on the loop a chunk at a time, encode and write off it
+    rows = await SESSIONS.snapshot_rows_async()
+    try:
+        await asyncio.to_thread(lambda: write_lines(SESSION_SNAPSHOT, encode_rows(rows)))
+    except OSError as e:
+        log.error(f"session snapshot failed: {e}")
+
+async def prefetch_facts(user_ids):
+    # warm the fact cache for recently active users, a few at a time
+    sem = asyncio.Semaphore(SNAPSHOT_PREFETCH_CONCURRENCY)
+
+    async def one(user_id):
+        async with sem:
+            await load_facts(user_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in user_ids))
+    log.info(f"Prefetched facts for {len(user_ids)} users in {time.perf_counter() - started:.1f}s")
+
+async def on_startup(app: Application):
+    # keep-alive routes (Render health checks) + webhook route, in this event loop
+    web_app = build_web_app(
+        app,
+        webhook_path=WEBHOOK_PATH if BOT_MODE == "webhook" else None,
+        webhook_secret=WEBHOOK_SECRET,
+        plan_webhook_path=PLAN_WEBHOOK_PATH,
+        plan_webhook_secret=PLAN_WEBHOOK_SECRET,
+        on_plan_change=apply_plan_row,
+    )
+    app.bot_data["http_runner"] = await start_http_server(web_app, "0.0.0.0", PORT)
 
-    # Telegram bot (polling)
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # ♻️ warm start: restore sessions from the last snapshot, then prefetch hot users
+    try:
+        restored = SESSIONS.load_snapshot(SESSION_SNAPSHOT, history_budget=HISTORY_TOKEN_BUDGET)
+    except OSError as e:
+        log.error(f"session snapshot load failed: {e}")
+        restored = 0
+
+    if restored:
+        log.info(f"Restored {restored} sessions from {SESSION_SNAPSHOT}")
+        app.create_task(prefetch_facts(SESSIONS.most_recent(SNAPSHOT_PREFETCH)))
+
+async def on_shutdown(app: Application):
+    runner = app.bot_data.pop("http_runner", None)
+    if runner:
+        await runner.cleanup()
+
+    await save_sessions_snapshot()
+    await flush_usage()
+
+    # release pooled Supabase + OpenAI connections
+    await supabase_client.aclose()
+    await tracing.aclose()
+    if scorer_log:
+        await scorer_log.aclose()
+    await client.close()
+
+def build_application(request: BaseRequest = None) -> Application:
+    """All handlers and jobs; `request` swaps out the Telegram transport (bench/ uses a stub)."""
+    processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES)
+    metrics.UPDATES_IN_FLIGHT.set_function(lambda: processor.active)
+
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(processor)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    app = builder.build()
 
     # commands
     app.add_handler(CommandHandler("start", start))
@@ -1225,16 +1821,69 @@ def main():
     app.add_handler(CommandHandler("devmode", devmode))
     app.add_handler(CommandHandler("reloadstate", reload_state))
     app.add_handler(CommandHandler("setplan", set_plan))
+    app.add_handler(CommandHandler("coachstats", coach_stats))
+    app.add_handler(CommandHandler("traces", traces_cmd))
     app.add_handler(CommandHandler("account", account_cmd))
     app.add_handler(CommandHandler("resetmemory", resetmemory_cmd))
+    app.add_handler(CommandHandler("timezone", timezone_cmd))
+    app.add_handler(CommandHandler("mood", mood_cmd))
     app.add_handler(CallbackQueryHandler(resetmemory_callback, pattern="reset_memory_.*"))
 
 
     # messages
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
 
-    # run
-    app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    # daily mood reminder, fanned out under Telegram's rate limits
+    app.bot_data["broadcaster"] = Broadcaster(app.bot)
+    app.job_queue.run_repeating(daily_mood_reminder, interval=MOOD_REMINDER_TICK, first=MOOD_REMINDER_TICK)
+
+    # housekeeping
+    app.job_queue.run_repeating(flush_usage, interval=USAGE_FLUSH_INTERVAL, first=USAGE_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(reconcile_entitlements, interval=ENTITLEMENT_RECONCILE_INTERVAL, first=ENTITLEMENT_RECONCILE_INTERVAL)
+    app.job_queue.run_repeating(sweep_sessions, interval=600, first=600)
+    app.job_queue.run_repeating(save_sessions_snapshot, interval=SESSION_SNAPSHOT_INTERVAL, first=SESSION_SNAPSHOT_INTERVAL)
+
+    return app
+
+async def run_webhook(app: Application):
+    """Webhook mode: Telegram POSTs updates to our HTTP server, no getUpdates long-polling."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await app.initialize()
+    await on_startup(app)  # starts the HTTP server with the webhook route
+
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+    else:
+        log.warning("WEBHOOK_URL not set; not registering a webhook with Telegram (local testing)")
+
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+
+def main():
+    app = build_application()
+
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        # polling; the HTTP server still runs for health checks (started in on_startup)
+        app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
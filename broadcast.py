@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Iterable
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+
+log = logging.getLogger("sofia")
+
+# Telegram allows ~30 messages/s per bot overall and ~1/s into one chat
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1.0"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "32"))
+BROADCAST_MAX_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Async token bucket; pause() stops everyone, for Telegram flood-control waits."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        # the lock makes waiters line up, so sends go out in order at `rate`
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BroadcastResult:
+    __slots__ = ("delivered", "failed", "blocked", "retries", "elapsed")
+
+    def __init__(self):
+        self.delivered = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.elapsed = 0.0
+
+    def as_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __str__(self) -> str:
+        return (
+            f"delivered={self.delivered} failed={self.failed} blocked={self.blocked} "
+            f"retries={self.retries} in {self.elapsed:.1f}s"
+        )
+
+
+class Broadcaster:
+    """
+    Sends one message to many chats concurrently without tripping flood control.
+
+    A pool of workers shares a global token bucket (BROADCAST_RATE/s) and
+    keeps at least BROADCAST_CHAT_INTERVAL between messages to the same chat.
+    RetryAfter pauses the whole bucket for the time Telegram asks, then the
+    message is retried; users who blocked the bot are counted, not retried.
+    """
+
+    def __init__(self, bot, rate: float = BROADCAST_RATE, chat_interval: float = BROADCAST_CHAT_INTERVAL,
+                 workers: int = BROADCAST_WORKERS):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.workers = workers
+        # chat_id -> monotonic time of our last message there (this broadcast)
+        self._last_sent: Dict[int, float] = {}
+
+    async def send_all(self, chat_ids: Iterable[int], text: str, **kwargs) -> BroadcastResult:
+        result = BroadcastResult()
+        started = time.monotonic()
+        self._last_sent = {}
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+
+        async def worker():
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                outcome = await self._send(chat_id, text, result, **kwargs)
+                setattr(result, outcome, getattr(result, outcome) + 1)
+                metrics.BROADCAST_MESSAGES.labels(outcome).inc()
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, queue.qsize()))))
+        result.elapsed = time.monotonic() - started
+        return result
+
+    async def _send(self, chat_id: int, text: str, result: BroadcastResult, **kwargs) -> str:
+        for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+            wait = self._last_sent.get(chat_id, 0.0) + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.bucket.acquire()
+            self._last_sent[chat_id] = time.monotonic()
+
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return "delivered"
+            except RetryAfter as e:
+                # flood control applies to the whole bot, so everyone waits
+                log.warning(f"broadcast: RetryAfter {e.retry_after}s (chat {chat_id})")
+                self.bucket.pause(float(e.retry_after))
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                log.info(f"broadcast: chat {chat_id} rejected: {e}")
+                return "failed"
+            except NetworkError as e:
+                log.warning(f"broadcast: network error for chat {chat_id} (attempt {attempt}): {e}")
+                await asyncio.sleep(0.5 * attempt)
+
+            result.retries += 1
+
+        return "failed"
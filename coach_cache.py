@@ -0,0 +1,81 @@
+import re
+import time
+import random
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+def normalize_message(message: str) -> str:
+    """Cache key for a coaching question: lowercase, no punctuation, single spaces."""
+    text = message.lower().replace("’", "'")
+    text = re.sub(r"[^\w\s']", " ", text)
+    return " ".join(text.split())
+
+
+class CoachCache:
+    """
+    Answers for Coach Mode keyed on the normalized question.
+
+    Coach replies only depend on the static coach prompt and the message, so
+    repeated questions can be answered from memory. Each key keeps up to
+    `variants` answers; while a key isn't full, a `refresh_rate` share of its
+    hits is turned into a miss so new answers get collected for variety.
+    Keys expire after `ttl` seconds and the least recently used key is
+    evicted past `max_keys`.
+    """
+
+    def __init__(self, max_keys: int = 500, ttl: float = 86400.0, variants: int = 3, refresh_rate: float = 0.25):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.variants = variants
+        self.refresh_rate = refresh_rate
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, message: str) -> Optional[str]:
+        key = normalize_message(message)
+        entry = self._entries.get(key)
+
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            entry = None
+
+        if entry is None or (len(entry[1]) < self.variants and random.random() < self.refresh_rate):
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(entry[1])
+
+    def put(self, message: str, answer: str):
+        key = normalize_message(message)
+        if not key or not answer:
+            return
+
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = (time.monotonic(), [])
+            self._entries[key] = entry
+
+        answers = entry[1]
+        if answer not in answers:
+            answers.append(answer)
+            del answers[:-self.variants]
+
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
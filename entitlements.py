@@ -0,0 +1,133 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+log = logging.getLogger("sofia")
+
+PLANS = ("starter", "pro", "elite")
+# messages a plan may send in total; None = unlimited
+MESSAGE_LIMITS = {"starter": 20, "pro": None, "elite": None}
+
+
+def normalize_plan(plan: Optional[str]) -> str:
+    plan = (plan or "starter").lower().strip()
+    return plan if plan in PLANS else "starter"
+
+
+class Entitlement:
+    __slots__ = ("user_id", "plan", "email", "owner", "loaded_at")
+
+    def __init__(self, user_id: int, plan: str, email: Optional[str] = None, owner: Optional[int] = None):
+        self.user_id = user_id
+        self.plan = normalize_plan(plan)
+        self.email = email
+        # telegram_id user_plans has on record for `email` (None = not checked yet)
+        self.owner = owner
+        self.loaded_at = time.monotonic()
+
+    @property
+    def limit(self) -> Optional[int]:
+        return MESSAGE_LIMITS.get(self.plan)
+
+    def as_dict(self) -> Dict:
+        return {"plan": self.plan, "limit": self.limit, "email": self.email, "owner": self.owner}
+
+
+class EntitlementCache:
+    """
+    In-memory plan/limit/owner per user, so plan checks cost no I/O.
+
+    Entries are loaded once (from the user's facts) and then kept current by
+    pushes: update() from our own plan writes and from the plan-change
+    webhook, invalidate() when a change can't be applied
+    directly. `ttl` is only a safety net for missed pushes, next to the
+    periodic reconcile against user_plans.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[int], Awaitable[Optional[Entitlement]]],
+        ttl: float = 6 * 3600,
+        max_users: int = 20000,
+    ):
+        self._loader = loader
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries: "OrderedDict[int, Entitlement]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, user_id: int) -> Optional[Entitlement]:
+        ent = self._entries.get(user_id)
+        if ent is None:
+            return None
+        if time.monotonic() - ent.loaded_at > self.ttl:
+            self._entries.pop(user_id, None)
+            return None
+        self._entries.move_to_end(user_id)
+        return ent
+
+    async def get(self, user_id: int) -> Entitlement:
+        ent = self.peek(user_id)
+        if ent is not None:
+            self.hits += 1
+            return ent
+
+        self.misses += 1
+
+        # concurrent misses share one load
+        fut = self._inflight.get(user_id)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[user_id] = fut
+            try:
+                ent = await self._loader(user_id)
+                if ent is not None and self._inflight.get(user_id) is fut:
+                    self._store(ent)
+                fut.set_result(ent or Entitlement(user_id, "starter"))
+            except BaseException as e:
+                fut.set_exception(e)
+                fut.exception()
+                raise
+            finally:
+                if self._inflight.get(user_id) is fut:
+                    del self._inflight[user_id]
+
+        return await asyncio.shield(fut)
+
+    def update(self, user_id: int, plan: str, email: Optional[str] = None, owner: Optional[int] = None) -> Entitlement:
+        """Record a plan we know is current (our own write or a pushed change)."""
+        old = self._entries.get(user_id)
+        ent = Entitlement(
+            user_id,
+            plan,
+            email=email if email is not None else (old.email if old else None),
+            owner=owner if owner is not None else (old.owner if old else None),
+        )
+        # a load in flight started before this change; don't let it be cached
+        self._inflight.pop(user_id, None)
+        self._store(ent)
+        return ent
+
+    def invalidate(self, user_id: int):
+        self._inflight.pop(user_id, None)
+        self._entries.pop(user_id, None)
+
+    def by_email(self, email: str) -> List[Entitlement]:
+        email = email.lower().strip()
+        return [ent for ent in self._entries.values() if ent.email == email]
+
+    def entries(self) -> Iterable[Entitlement]:
+        return list(self._entries.values())
+
+    def _store(self, ent: Entitlement):
+        self._entries[ent.user_id] = ent
+        self._entries.move_to_end(ent.user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+
+class FactCache:
+    """
+    Per-user write-through cache of Supabase facts.
+
+    - entries expire after `ttl` seconds and the least recently used user is
+      evicted once more than `max_users` are cached
+    - concurrent misses for the same user share one in-flight load
+    - writes go through set()/delete() so the cached dict stays in sync
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[int], Awaitable[Optional[Dict[str, str]]]],
+        ttl: float = 60.0,
+        max_users: int = 5000,
+    ):
+        self._loader = loader
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries: "OrderedDict[int, Tuple[float, Dict[str, str]]]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+        # users written to while a load was in flight; that load may be stale
+        self._raced = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, user_id: int) -> Optional[Dict[str, str]]:
+        """Returns the cached facts (not a copy) without loading, or None."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            self._entries.pop(user_id, None)
+            return None
+        self._entries.move_to_end(user_id)
+        return entry[1]
+
+    async def get(self, user_id: int, fresh: bool = False) -> Dict[str, str]:
+        """Returns a copy of the user's facts, loading them on a miss."""
+        if not fresh:
+            facts = self.peek(user_id)
+            if facts is not None:
+                self.hits += 1
+                return dict(facts)
+
+        self.misses += 1
+
+        fut = self._inflight.get(user_id)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[user_id] = fut
+            try:
+                facts = await self._loader(user_id)
+                # failed or raced loads are not cached, the next call retries
+                if facts is not None and user_id not in self._raced:
+                    self._store(user_id, facts)
+                fut.set_result(facts or {})
+            except BaseException as e:
+                fut.set_exception(e)
+                # nobody else may be waiting; don't warn about an unread exception
+                fut.exception()
+                raise
+            finally:
+                self._inflight.pop(user_id, None)
+                self._raced.discard(user_id)
+
+        return dict(await asyncio.shield(fut))
+
+    def set(self, user_id: int, key: str, value: str):
+        self._mark_raced(user_id)
+        facts = self.peek(user_id)
+        if facts is not None:
+            facts[key] = value
+
+    def delete(self, user_id: int, key: str):
+        self._mark_raced(user_id)
+        facts = self.peek(user_id)
+        if facts is not None:
+            facts.pop(key, None)
+
+    def invalidate(self, user_id: int):
+        self._mark_raced(user_id)
+        self._entries.pop(user_id, None)
+
+    def cached_users(self) -> Iterable[int]:
+        return list(self._entries.keys())
+
+    def _mark_raced(self, user_id: int):
+        if user_id in self._inflight:
+            self._raced.add(user_id)
+
+    def _store(self, user_id: int, facts: Dict[str, str]):
+        self._entries[user_id] = (time.monotonic(), dict(facts))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
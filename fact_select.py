@@ -0,0 +1,88 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from prompt_builder import estimate_tokens
+
+# bookkeeping facts that never belong in the persona prompt
+INTERNAL_FACT_KEYS = {
+    "plan",
+    "messages_used",
+    "memory_count",
+    "telegram_id",
+    "email",
+    "activation_date",
+    "mood",
+    "mood_timestamp",
+    "level",
+    "level_version",
+    "difficulty",
+    "timezone",
+    "reminded_on",
+    "authorized",
+}
+
+# identity facts that win ties when nothing in the message matches
+PINNED_FACT_KEYS = ("name", "age", "city", "country", "job", "relationship_goal")
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD.findall(text.lower().replace("_", " "))
+
+
+def bm25_scores(query: List[str], docs: List[List[str]], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    """Okapi BM25 score of every doc against the query, over this small corpus."""
+    if not docs:
+        return []
+
+    n = len(docs)
+    avg_len = sum(len(d) for d in docs) / n or 1.0
+    df = Counter(term for d in docs for term in set(d))
+    query_terms = set(query)
+
+    scores = []
+    for d in docs:
+        tf = Counter(d)
+        score = 0.0
+        for term in query_terms:
+            if term not in tf:
+                continue
+            idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+            f = tf[term]
+            score += idf * f * (k1 + 1) / (f + k1 * (1 - b + b * len(d) / avg_len))
+        scores.append(score)
+    return scores
+
+
+def select_facts(facts: Dict[str, str], message: str, token_budget: int) -> List[Tuple[str, str]]:
+    """
+    Picks the facts worth injecting for this message: internal keys are
+    dropped, the rest ranked by BM25 relevance of "key value" to the message
+    (pinned identity keys, then original order, break ties), and lines are
+    taken greedily while they fit in token_budget.
+    """
+    items = [(k, v) for k, v in facts.items() if k not in INTERNAL_FACT_KEYS and v]
+    if not items:
+        return []
+
+    scores = bm25_scores(tokenize(message), [tokenize(f"{k} {v}") for k, v in items])
+
+    def rank(i: int):
+        key = items[i][0]
+        pinned = PINNED_FACT_KEYS.index(key) if key in PINNED_FACT_KEYS else len(PINNED_FACT_KEYS)
+        return (-scores[i], pinned, i)
+
+    selected = []
+    used = 0
+    for i in sorted(range(len(items)), key=rank):
+        k, v = items[i]
+        cost = estimate_tokens(f"- {k}: {v}\n")
+        if used + cost > token_budget:
+            continue
+        selected.append((k, v))
+        used += cost
+
+    return selected
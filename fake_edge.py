@@ -0,0 +1,158 @@
+"""
+Local stand-in for the Supabase Edge Function, for testing without Supabase.
+
+Implements the same JSON actions bot.py sends (load, update, delete,
+update_many, delete_many, increment, cas, scan, set_many,
+get_plan_by_email) against an
+in-memory store.
+
+    python fake_edge.py --port 8787
+    SUPABASE_EDGE_URL=http://127.0.0.1:8787 python bot.py
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from typing import Dict
+
+
+class EdgeStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user_id -> {key: value}
+        self.facts: Dict[str, Dict[str, str]] = {}
+        # email -> plan
+        self.plans: Dict[str, str] = {}
+        # increment batch_id -> the totals it produced (recent ones only)
+        self.batches: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self.requests = 0
+
+    def handle(self, body: Dict):
+        action = body.get("action")
+        user = str(body.get("user_id", ""))
+
+        with self.lock:
+            self.requests += 1
+            facts = self.facts.setdefault(user, {}) if user else {}
+
+            if action == "load":
+                return 200, [{"key": k, "value": v} for k, v in facts.items()]
+
+            if action == "update":
+                facts[body["key"]] = body["value"]
+                return 200, {"ok": True}
+
+            if action == "delete":
+                facts.pop(body["key"], None)
+                return 200, {"ok": True}
+
+            if action == "update_many":
+                facts.update(body.get("facts") or {})
+                return 200, {"ok": True, "count": len(body.get("facts") or {})}
+
+            if action == "delete_many":
+                keys = body.get("keys") or []
+                for k in keys:
+                    facts.pop(k, None)
+                return 200, {"ok": True, "count": len(keys)}
+
+            if action == "increment":
+                # {"key": k, "batch_id": id, "deltas": {user_id: n}} -> new totals, applied atomically, once per id
+                key = body["key"]
+                batch_id = body.get("batch_id")
+                if batch_id and batch_id in self.batches:
+                    return 200, {"ok": True, "values": self.batches[batch_id], "duplicate": True}
+                values = {}
+                for uid, n in (body.get("deltas") or {}).items():
+                    row = self.facts.setdefault(str(uid), {})
+                    total = int(row.get(key) or 0) + int(n)
+                    row[key] = str(total)
+                    values[str(uid)] = total
+                if batch_id:
+                    self.batches[batch_id] = values
+                    while len(self.batches) > 10000:
+                        self.batches.popitem(last=False)
+                return 200, {"ok": True, "values": values}
+
+            if action == "scan":
+                # users that have fact `require`, with their `keys`, paged by user_id
+                require, keys = body["require"], body.get("keys") or []
+                after, limit = str(body.get("after") or ""), int(body.get("limit") or 1000)
+                ids = sorted(uid for uid, row in self.facts.items() if require in row and uid > after)
+                page = ids[:limit]
+                users = {uid: {k: self.facts[uid][k] for k in keys if k in self.facts[uid]} for uid in page}
+                return 200, {"users": users, "next": page[-1] if len(ids) > limit else None}
+
+            if action == "set_many":
+                # {"key": k, "values": {user_id: value}} - one fact for many users
+                key = body["key"]
+                for uid, value in (body.get("values") or {}).items():
+                    self.facts.setdefault(str(uid), {})[key] = value
+                return 200, {"ok": True, "count": len(body.get("values") or {})}
+
+            if action == "cas":
+                # set key only if version_key still holds `expected` (and key `expected_value`, if given)
+                # or force, bumping the version
+                vkey = body["version_key"]
+                current = int(facts.get(vkey) or 0)
+                stored, expected_value = facts.get(body["key"]), body.get("expected_value")
+                changed = expected_value is not None and stored is not None and stored != expected_value
+                if not body.get("force") and (current != int(body.get("expected") or 0) or changed):
+                    return 409, {"ok": False, "value": facts.get(body["key"]), "version": current}
+                facts[body["key"]] = body["value"]
+                facts[vkey] = str(current + 1)
+                return 200, {"ok": True, "value": body["value"], "version": current + 1}
+
+            if action == "get_plan_by_email":
+                plan = self.plans.get((body.get("email") or "").lower())
+                if plan is None:
+                    return 404, {"error": "not found"}
+                return 200, {"plan": plan}
+
+        return 400, {"error": f"unknown action {action!r}", "code": "unknown_action"}
+
+
+def make_server(store: EdgeStore, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+                status, payload = store.handle(body)
+            except (ValueError, KeyError) as e:
+                status, payload = 400, {"error": str(e)}
+
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--plan", action="append", default=[], metavar="EMAIL=PLAN",
+                        help="seed a purchase, e.g. --plan me@example.com=pro")
+    args = parser.parse_args()
+
+    store = EdgeStore()
+    for item in args.plan:
+        email, _, plan = item.partition("=")
+        store.plans[email.lower()] = plan
+
+    server = make_server(store, args.host, args.port)
+    print(f"fake edge listening on http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from prompt_builder import estimate_tokens
+
+log = logging.getLogger("sofia")
+
+# (role, text, estimated tokens)
+Turn = Tuple[str, str, int]
+
+# summarizer(previous_summary, overflowed_turns) -> new summary
+Summarizer = Callable[[str, List[Turn]], Awaitable[str]]
+
+SUMMARY_MAX_CHARS = 800
+
+
+class ConversationHistory:
+    """
+    Recent turns for one user, bounded by an estimated token budget.
+
+    When the buffer goes over budget the oldest turns move to a pending list
+    and a background task folds them into a rolling summary, so the reply
+    path never waits on summarization and prompt size stays flat however
+    long the conversation runs.
+    """
+
+    def __init__(self, token_budget: int = 600, min_turns: int = 2):
+        self.token_budget = token_budget
+        self.min_turns = min_turns
+        self.turns: Deque[Turn] = deque()
+        self.tokens = 0
+        self.summary = ""
+        self._pending: List[Turn] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, role: str, text: str):
+        text = (text or "").strip()
+        if not text:
+            return
+        turn = (role, text, estimate_tokens(text))
+        self.turns.append(turn)
+        self.tokens += turn[2]
+
+        while self.tokens > self.token_budget and len(self.turns) > self.min_turns:
+            old = self.turns.popleft()
+            self.tokens -= old[2]
+            self._pending.append(old)
+
+    def messages(self) -> List[Dict[str, str]]:
+        """Recent turns as chat messages, oldest first."""
+        return [{"role": role, "content": text} for role, text, _ in self.turns]
+
+    def transcript(self, max_turns: int = 4) -> str:
+        """Last few turns as plain text (for the scorer)."""
+        recent = list(self.turns)[-max_turns:]
+        names = {"user": "User", "assistant": "Sofia"}
+        return "\n".join(f"{names.get(role, role)}: {text}" for role, text, _ in recent)
+
+    def last_assistant(self) -> Optional[str]:
+        for role, text, _ in reversed(self.turns):
+            if role == "assistant":
+                return text
+        return None
+
+    def maybe_summarize(self, summarizer: Summarizer):
+        """Fold overflowed turns into the summary in the background, if any."""
+        if not self._pending or (self._task and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._summarize(summarizer))
+
+    async def _summarize(self, summarizer: Summarizer):
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                summary = (await summarizer(self.summary, batch)).strip()
+                if summary:
+                    self.summary = summary[:SUMMARY_MAX_CHARS]
+            except Exception as e:
+                # dropping the batch keeps memory bounded; the summary just misses it
+                log.warning(f"history summarize error: {e}")
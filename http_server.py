@@ -0,0 +1,124 @@
+import hmac
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+log = logging.getLogger("sofia")
+
+# aiohttp app key for the PTB Application
+PTB_APP = web.AppKey("ptb_app", Application)
+
+# on_plan_change(row, deleted) -> number of users whose entitlements changed
+PlanChangeHandler = Callable[[Dict, bool], Awaitable[int]]
+
+
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="Bot is alive!")
+
+
+async def ping(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    body, content_type = metrics.render()
+    return web.Response(body=body, headers={"Content-Type": content_type})
+
+
+def make_webhook_handler(secret: str):
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(got, secret):
+            return web.Response(status=403, text="forbidden")
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="bad json")
+
+        app = request.app[PTB_APP]
+        update = Update.de_json(data, app.bot)
+        if update is None:
+            return web.Response(status=400, text="bad update")
+
+        # hand off to PTB's dispatcher; reply fast so Telegram doesn't retry
+        await app.update_queue.put(update)
+        return web.Response(text="ok")
+
+    return telegram_webhook
+
+
+def make_plan_webhook_handler(secret: str, on_plan_change: PlanChangeHandler):
+    """
+    Plan changes pushed by Sellfy/Supabase. Accepts a bare user_plans row
+    ({"email", "plan", "telegram_id"}) or a Supabase database-webhook
+    payload ({"type", "record", "old_record"}).
+    """
+    async def plan_webhook(request: web.Request) -> web.Response:
+        got = request.headers.get("X-Webhook-Secret", "")
+        if not hmac.compare_digest(got, secret):
+            return web.Response(status=403, text="forbidden")
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="bad json")
+        if not isinstance(data, dict):
+            return web.Response(status=400, text="bad payload")
+
+        deleted = data.get("type") == "DELETE"
+        row = (data.get("old_record") if deleted else data.get("record")) or data
+        if not isinstance(row, dict) or not (row.get("email") or row.get("telegram_id")):
+            return web.Response(status=400, text="missing email/telegram_id")
+
+        changed = await on_plan_change(row, deleted)
+        return web.json_response({"ok": True, "changed": changed})
+
+    return plan_webhook
+
+
+def build_web_app(
+    app: Application,
+    webhook_path: Optional[str] = None,
+    webhook_secret: Optional[str] = None,
+    plan_webhook_path: Optional[str] = None,
+    plan_webhook_secret: Optional[str] = None,
+    on_plan_change: Optional[PlanChangeHandler] = None,
+) -> web.Application:
+    """
+    One asyncio HTTP server in the bot's event loop: keep-alive routes for
+    Render health checks, Prometheus /metrics, the Telegram webhook route in
+    webhook mode, and the plan-change webhook when a secret is configured.
+    """
+    web_app = web.Application()
+    web_app[PTB_APP] = app
+    web_app.router.add_get("/", home)
+    web_app.router.add_get("/ping", ping)
+    web_app.router.add_get("/metrics", metrics_endpoint)
+
+    # never expose an unauthenticated Telegram route: forged updates could act as any user
+    if webhook_path:
+        if not webhook_secret:
+            raise ValueError("webhook mode needs a webhook secret")
+        web_app.router.add_post(webhook_path, make_webhook_handler(webhook_secret))
+
+    # never expose an unauthenticated plan-change route
+    if plan_webhook_path and plan_webhook_secret and on_plan_change:
+        web_app.router.add_post(plan_webhook_path, make_plan_webhook_handler(plan_webhook_secret, on_plan_change))
+    elif plan_webhook_path and on_plan_change:
+        log.warning("PLAN_WEBHOOK_SECRET not set; plan-change webhook disabled")
+
+    return web_app
+
+
+async def start_http_server(web_app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"HTTP server listening on {host}:{port}")
+    return runner
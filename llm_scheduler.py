@@ -0,0 +1,198 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import logging
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+import metrics
+
+log = logging.getLogger("sofia")
+
+T = TypeVar("T")
+
+# account limits for the model we call (gpt-4o-mini, tier 1 by default)
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+# how many seconds of the per-minute budget may be spent in one burst
+LLM_BURST_SECONDS = float(os.getenv("LLM_BURST_SECONDS", "10"))
+# longest a request may wait in the queue before it is shed, per plan
+LLM_MAX_WAIT = {
+    "elite": float(os.getenv("LLM_MAX_WAIT_ELITE", "60")),
+    "pro": float(os.getenv("LLM_MAX_WAIT_PRO", "45")),
+    "starter": float(os.getenv("LLM_MAX_WAIT_STARTER", "8")),
+    "background": float(os.getenv("LLM_MAX_WAIT_BACKGROUND", "30")),
+}
+# with this many requests already queued, new starter/background work is shed at once
+LLM_SHED_DEPTH = int(os.getenv("LLM_SHED_DEPTH", "100"))
+LLM_MAX_ATTEMPTS = 4
+LLM_BACKOFF_BASE = 0.5
+
+# lower runs first; background = work nobody is waiting on (history summaries)
+PRIORITY = {"elite": 0, "pro": 1, "starter": 2, "background": 3}
+SHEDDABLE = PRIORITY["starter"]
+
+
+class LLMShed(Exception):
+    """The request was dropped to protect higher-plan traffic; callers fall back."""
+
+
+class _Bucket:
+    """Continuous-refill bucket; `level` may go negative when actual usage beats the estimate."""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` is available (0 if it is now)."""
+        amount = min(amount, self.capacity)
+        missing = amount - self.level
+        return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
+
+
+class LLMScheduler:
+    """
+    Admission control for OpenAI calls.
+
+    Every call takes one request and an estimated number of tokens from two
+    buckets (RPM and TPM). When they run dry, calls queue by plan priority
+    (elite, pro, starter, then background) and a dispatcher lets them out as
+    capacity refills. Starter and background calls are shed, raising LLMShed,
+    if the queue is already deep or they wait longer than their plan allows,
+    so paying users keep low latency during spikes. 429s (and transient
+    connection/5xx errors) are retried with full-jitter backoff; a 429 with
+    Retry-After pauses admissions for everyone.
+    """
+
+    def __init__(self, rpm: int = OPENAI_RPM, tpm: int = OPENAI_TPM, burst_seconds: float = LLM_BURST_SECONDS):
+        self.requests = _Bucket(rpm, burst_seconds)
+        self.tokens = _Bucket(tpm, burst_seconds)
+        self.paused_until = 0.0
+        # (priority, seq, tokens, plan, future)
+        self._queue: List = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def queued(self) -> int:
+        return sum(1 for item in self._queue if not item[4].done())
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def settle(self, estimated: int, actual: int):
+        """Correct the token bucket once the real usage is known."""
+        self.tokens.level -= actual - estimated
+
+    # -----------------------------
+    # Admission
+    # -----------------------------
+
+    def _delay(self, tokens: int) -> float:
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.paused_until - now, self.requests.wait_for(1), self.tokens.wait_for(tokens))
+
+    def _take(self, tokens: int):
+        self.requests.level -= 1
+        self.tokens.level -= min(tokens, self.tokens.capacity)
+
+    async def acquire(self, plan: str, tokens: int):
+        priority = PRIORITY.get(plan, SHEDDABLE)
+
+        # fast path: nobody waiting and capacity available
+        if not self.queued() and self._delay(tokens) <= 0:
+            self._take(tokens)
+            return
+
+        if priority >= SHEDDABLE and self.queued() >= LLM_SHED_DEPTH:
+            metrics.LLM_SHED.labels(plan).inc()
+            raise LLMShed(f"queue depth {self.queued()}")
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, plan, fut))
+        self._ensure_dispatcher()
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, LLM_MAX_WAIT.get(plan, LLM_MAX_WAIT["starter"]))
+        except asyncio.TimeoutError:
+            metrics.LLM_SHED.labels(plan).inc()
+            raise LLMShed(f"waited {time.monotonic() - started:.1f}s")
+        finally:
+            metrics.LLM_QUEUE_SECONDS.labels(plan).observe(time.monotonic() - started)
+
+    def _ensure_dispatcher(self):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        self._wake.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while self._queue:
+            priority, _, tokens, plan, fut = self._queue[0]
+            if fut.done():
+                # timed out / cancelled while queued
+                heapq.heappop(self._queue)
+                continue
+
+            delay = self._delay(tokens)
+            if delay <= 0:
+                heapq.heappop(self._queue)
+                self._take(tokens)
+                fut.set_result(None)
+                continue
+
+            # a higher-priority arrival wakes us early and becomes the new head
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    # -----------------------------
+    # Calls
+    # -----------------------------
+
+    async def run(self, plan: str, tokens: int, call: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Admit, run fn(), and retry rate limits / transient errors with jittered backoff."""
+        for attempt in range(1, LLM_MAX_ATTEMPTS + 1):
+            await self.acquire(plan, tokens)
+            try:
+                return await fn()
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == LLM_MAX_ATTEMPTS:
+                    raise
+
+                backoff = LLM_BACKOFF_BASE * 2 ** (attempt - 1)
+                if isinstance(e, RateLimitError):
+                    retry_after = _retry_after(e)
+                    if retry_after:
+                        self.pause(retry_after)
+                        backoff = max(backoff, retry_after)
+
+                delay = random.uniform(0, backoff)
+                metrics.LLM_RETRIES.labels(call).inc()
+                log.warning(f"OpenAI {call}: {type(e).__name__}, retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+
+def _retry_after(e: RateLimitError) -> Optional[float]:
+    try:
+        value = e.response.headers.get("retry-after")
+        return float(value) if value else None
+    except (AttributeError, ValueError):
+        return None
@@ -0,0 +1,87 @@
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# network calls: a few ms (warm pool) up to the 8s timeout
+NETWORK_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16)
+# a whole chat() turn includes the humanized pacing
+TURN_BUCKETS = (0.5, 1, 2, 4, 6, 8, 12, 16, 24, 32, 60)
+
+SUPABASE_SECONDS = Histogram(
+    "sofia_supabase_request_seconds",
+    "Latency of Supabase calls by Edge action (or REST helper).",
+    ["action"],
+    buckets=NETWORK_BUCKETS,
+)
+
+OPENAI_SECONDS = Histogram(
+    "sofia_openai_request_seconds",
+    "Latency of OpenAI calls by call type (streamed replies: until the stream opens).",
+    ["call"],
+    buckets=NETWORK_BUCKETS,
+)
+
+LLM_QUEUE_SECONDS = Histogram(
+    "sofia_llm_queue_seconds",
+    "Time OpenAI calls waited for rate-limit admission, by plan.",
+    ["plan"],
+    buckets=(0.005, 0.05, 0.25, 1, 2, 4, 8, 16, 32, 60),
+)
+
+LLM_SHED = Counter(
+    "sofia_llm_shed_total",
+    "OpenAI calls dropped by the scheduler to protect higher plans.",
+    ["plan"],
+)
+
+LLM_RETRIES = Counter(
+    "sofia_llm_retries_total",
+    "OpenAI calls retried after a 429 or transient error, by call type.",
+    ["call"],
+)
+
+CHAT_TURN_SECONDS = Histogram(
+    "sofia_chat_turn_seconds",
+    "End-to-end time of one chat() turn, pacing included.",
+    buckets=TURN_BUCKETS,
+)
+
+FALLBACKS = Counter(
+    "sofia_fallbacks_total",
+    "Times a degraded path was taken (score_regex, score_heuristic, reply, coach_empty).",
+    ["kind"],
+)
+
+SCORER_ROUTE = Counter(
+    "sofia_scorer_route_total",
+    "Messages scored per tier (local pre-scorer or LLM).",
+    ["tier"],
+)
+
+BROADCAST_MESSAGES = Counter(
+    "sofia_broadcast_messages_total",
+    "Broadcast sends by outcome (delivered, failed, blocked).",
+    ["outcome"],
+)
+
+PLAN_CHANGES = Counter(
+    "sofia_plan_changes_total",
+    "Plan changes applied to entitlements, by source (webhook, reconcile).",
+    ["source"],
+)
+
+SESSIONS = Gauge("sofia_sessions", "Sessions held in memory.")
+AUTHORIZED_SESSIONS = Gauge("sofia_authorized_sessions", "In-memory sessions past the password gate.")
+FACT_CACHE_USERS = Gauge("sofia_fact_cache_users", "Users whose facts are cached.")
+ENTITLEMENT_USERS = Gauge("sofia_entitlement_cache_users", "Users whose plan/limits are cached.")
+UPDATES_IN_FLIGHT = Gauge("sofia_updates_in_flight", "Updates being handled right now (per-user queued ones excluded).")
+
+
+def render():
+    """(body, content type) for the /metrics endpoint."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,108 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+import tracing
+
+log = logging.getLogger("sofia")
+
+# total humanized delay per reply (seconds); model time counts toward it
+REPLY_DELAY_MIN = float(os.getenv("REPLY_DELAY_MIN", "3"))
+REPLY_DELAY_MAX = float(os.getenv("REPLY_DELAY_MAX", "8"))
+# how fast "Sofia types" when spacing out the chunks of one reply
+TYPING_CPS = float(os.getenv("TYPING_CPS", "14"))
+# never send two chunks closer together than this
+MIN_CHUNK_GAP = float(os.getenv("MIN_CHUNK_GAP", "0.6"))
+# Telegram clears "typing..." after ~5s, so refresh a bit before that
+TYPING_REFRESH = 4.0
+
+
+class ReplyPacer:
+    """
+    Paces one reply like a human typing it, without stacking sleeps.
+
+    - a background task keeps the typing indicator alive for the whole turn,
+      so it shows while scoring and generation run
+    - each chunk is due after its own typing time (len / TYPING_CPS), but the
+      whole reply is capped at a total budget drawn from
+      REPLY_DELAY_MIN..REPLY_DELAY_MAX measured from start(), so time already
+      spent on model calls counts toward it
+    """
+
+    def __init__(self, bot, chat_id: int, budget: float = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.budget = budget if budget is not None else random.uniform(REPLY_DELAY_MIN, REPLY_DELAY_MAX)
+        self.started = None
+        self.last_sent = None
+        self.sent = 0
+        self.slept = 0.0
+        # whether the indicator should be showing; off once a chunk is sent
+        # until the next one is on its way, so it doesn't linger after the last
+        self._typing = True
+        self._kick = asyncio.Event()
+        self._typing_task = None
+
+    def start(self):
+        self.started = self.last_sent = time.monotonic()
+        self._typing_task = asyncio.create_task(self._keep_typing())
+
+    def stop(self):
+        if self._typing_task:
+            self._typing_task.cancel()
+            self._typing_task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.stop()
+
+    async def _keep_typing(self):
+        while True:
+            if self._typing:
+                try:
+                    with tracing.span("telegram.typing"):
+                        await self.bot.send_chat_action(self.chat_id, "typing")
+                except Exception:
+                    pass
+            self._kick.clear()
+            try:
+                await asyncio.wait_for(self._kick.wait(), TYPING_REFRESH)
+            except asyncio.TimeoutError:
+                pass
+
+    def due(self, text: str) -> float:
+        """Monotonic time at which this chunk should go out."""
+        typing_time = len(text) / TYPING_CPS if TYPING_CPS > 0 else 0.0
+        gap = MIN_CHUNK_GAP if self.sent else 0.0
+        natural = self.last_sent + max(typing_time, gap)
+        deadline = self.started + self.budget
+        return max(min(natural, deadline), self.last_sent + gap)
+
+    async def wait(self, text: str):
+        if not self._typing:
+            # sending a message cleared the indicator; show it again right away
+            self._typing = True
+            self._kick.set()
+        delay = self.due(text) - time.monotonic()
+        if delay > 0:
+            self.slept += delay
+            with tracing.span("pacing.sleep"):
+                await asyncio.sleep(delay)
+
+    async def reply(self, message, text: str, **kwargs):
+        """Wait until the chunk is due, then send it."""
+        await self.wait(text)
+        with tracing.span("telegram.send_message", chars=len(text)):
+            result = await message.reply_text(text, **kwargs)
+        self.last_sent = time.monotonic()
+        self.sent += 1
+        self._typing = False
+        return result
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started if self.started else 0.0
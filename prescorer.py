@@ -0,0 +1,450 @@
+"""
+Local pre-scorer: scores trivial messages ("ok", "lol", "hey") without
+calling the LLM scorer.
+
+A small linear model over hand-made text features, trained offline on the
+scorer's own logged outputs (SCORER_LOG):
+
+  - "trivial" head, logistic: P(the LLM would rate the message below
+    trivial_max on average). trivial_max defaults to the lowest "bad"
+    threshold, so a trivial message moves the level the same way (-1) in
+    every difficulty.
+  - "flirty" / "personality" heads, linear: the scores to use when the
+    message is handled locally.
+
+A message is handled locally only if it is short (<= max_words) and the
+trivial head is confident (>= threshold); everything else goes to the LLM.
+Runtime is pure Python; training uses numpy when it is installed.
+
+    python -m prescorer train scorer_log.jsonl -o prescorer_weights.json
+    python -m prescorer report replay.jsonl --weights prescorer_weights.json
+"""
+import re
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import operator
+import argparse
+from typing import Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("sofia")
+
+# words that carry no content on their own
+FILLER_WORDS = {
+    "ok", "okay", "k", "kk", "lol", "lmao", "haha", "hahaha", "hehe", "hey", "hi", "hello", "yo", "sup",
+    "yes", "yeah", "yep", "ya", "no", "nah", "nope", "hmm", "hm", "cool", "nice", "sure", "fine", "thanks",
+    "thx", "ty", "oh", "ah", "wow", "idk", "same", "true", "right", "mhm", "u", "you", "too",
+}
+# same list as the heuristic fallback in parse_scores
+FLIRT_WORDS = ["date", "kiss", "cute", "pretty", "gorgeous", "dinner", "tomorrow", "your place", "my place"]
+FEATURES = [
+    "bias", "chars", "words", "filler", "only_filler", "question", "exclaim",
+    "emoji", "flirt_words", "you", "me", "unique", "long_words",
+]
+HEADS = ("trivial", "flirty", "personality")
+
+_WORD = re.compile(r"[a-z']+")
+_EMOJI = re.compile("[\U0001F300-\U0001FAFF☀-➿]")
+
+
+def features(message: str) -> List[float]:
+    """Feature vector for a message, in FEATURES order."""
+    text = message.lower().strip()
+    words = _WORD.findall(text)
+    n = len(words)
+    filler = sum(1 for w in words if w in FILLER_WORDS)
+    return [
+        1.0,
+        math.log1p(len(text)) / 5.0,
+        min(n, 40) / 40.0,
+        filler / n if n else 1.0,
+        1.0 if filler == n else 0.0,
+        1.0 if "?" in text else 0.0,
+        1.0 if "!" in text else 0.0,
+        min(len(_EMOJI.findall(message)), 3) / 3.0,
+        min(sum(1 for w in FLIRT_WORDS if w in text), 3) / 3.0,
+        1.0 if any(w in ("you", "your", "u", "ur", "you're") for w in words) else 0.0,
+        1.0 if any(w in ("i", "i'm", "im", "my", "me") for w in words) else 0.0,
+        len(set(words)) / n if n else 0.0,
+        sum(1 for w in words if len(w) >= 6) / n if n else 0.0,
+    ]
+
+
+def word_count(message: str) -> int:
+    return len(_WORD.findall(message.lower()))
+
+
+def _dot(w: Sequence[float], x: Sequence[float]) -> float:
+    return sum(a * b for a, b in zip(w, x))
+
+
+def _sigmoid(z: float) -> float:
+    if z >= 0:
+        return 1.0 / (1.0 + math.exp(-z))
+    e = math.exp(z)
+    return e / (1.0 + e)
+
+
+class Prediction:
+    __slots__ = ("p_trivial", "flirty", "personality")
+
+    def __init__(self, p_trivial: float, flirty: int, personality: int):
+        self.p_trivial = p_trivial
+        self.flirty = flirty
+        self.personality = personality
+
+    def raw(self) -> str:
+        """Same shape as the LLM scorer's JSON, so callers can treat both alike."""
+        return json.dumps({
+            "flirty": self.flirty,
+            "personality": self.personality,
+            "rationale": "local pre-scorer",
+            "p_trivial": round(self.p_trivial, 3),
+        })
+
+
+class PreScorer:
+    def __init__(self, weights: Dict[str, List[float]], trivial_max: float = 3.9,
+                 threshold: float = 0.9, max_words: int = 6, meta: Dict = None):
+        self.weights = weights
+        self.trivial_max = trivial_max
+        self.threshold = threshold
+        self.max_words = max_words
+        self.meta = meta or {}
+
+    @classmethod
+    def load(cls, path: str) -> Optional["PreScorer"]:
+        """Reads a weights file; None (LLM-only scoring) if it's missing or doesn't match FEATURES."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning(f"pre-scorer weights unreadable ({path}): {e}")
+            return None
+
+        if data.get("features") != FEATURES or set(data.get("weights", {})) != set(HEADS):
+            log.warning(f"pre-scorer weights in {path} don't match this version's features; ignoring them")
+            return None
+
+        return cls(
+            data["weights"],
+            trivial_max=float(data.get("trivial_max", 3.9)),
+            threshold=float(data.get("threshold", 0.9)),
+            max_words=int(data.get("max_words", 6)),
+            meta=data.get("meta"),
+        )
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "features": FEATURES,
+                "weights": {head: [round(v, 6) for v in w] for head, w in self.weights.items()},
+                "trivial_max": self.trivial_max,
+                "threshold": self.threshold,
+                "max_words": self.max_words,
+                "meta": self.meta,
+            }, f, indent=2)
+
+    def predict(self, message: str) -> Prediction:
+        x = features(message)
+        return Prediction(
+            _sigmoid(_dot(self.weights["trivial"], x)),
+            max(0, min(10, round(_dot(self.weights["flirty"], x)))),
+            max(0, min(10, round(_dot(self.weights["personality"], x)))),
+        )
+
+    def decide(self, message: str) -> Tuple[Prediction, bool]:
+        """(prediction, handle locally?) - local only for short messages the model is sure are trivial."""
+        pred = self.predict(message)
+        local = (
+            word_count(message) <= self.max_words
+            and pred.p_trivial >= self.threshold
+            # the local scores must land in the same bucket the trivial head promised
+            and (pred.flirty + pred.personality) / 2.0 < self.trivial_max
+        )
+        return pred, local
+
+
+# =============================
+# Scorer log (training / replay data)
+# =============================
+
+class ExampleLog:
+    """
+    Appends scored messages to a JSONL log; source is "llm" or "local" (only
+    llm rows are labels). add() only buffers, so scoring never waits on the
+    disk: a background task appends the rows via asyncio.to_thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._buffer: List[str] = []
+        self._writer: Optional[asyncio.Task] = None
+
+    def add(self, message: str, flirty: int, personality: int, source: str, p_trivial: Optional[float] = None):
+        row = {"ts": int(time.time()), "message": message, "flirty": flirty, "personality": personality, "source": source}
+        if p_trivial is not None:
+            row["p_trivial"] = round(p_trivial, 4)
+        self._buffer.append(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write())
+
+    async def aclose(self):
+        if self._writer is not None:
+            await self._writer
+
+    def _append(self, lines: List[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    async def _write(self):
+        # rows added while a batch is being written go out in the next one
+        while self._buffer:
+            lines = self._buffer[:]
+            del self._buffer[:]
+            try:
+                await asyncio.to_thread(self._append, lines)
+            except OSError as e:
+                log.warning(f"scorer log write failed: {e}")
+
+
+def load_examples(path: str) -> List[Dict]:
+    """LLM-labelled rows from a scorer log (local rows carry no label and are skipped)."""
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if row.get("source", "llm") == "llm" and isinstance(row.get("message"), str):
+                rows.append(row)
+    return rows
+
+
+# =============================
+# Training
+# =============================
+
+def _solve(A: List[List[float]], b: List[float]) -> List[float]:
+    """Solves A x = b (Gaussian elimination, partial pivoting); A is small and well-conditioned by l2."""
+    n = len(b)
+    M = [row[:] + [b[i]] for i, row in enumerate(A)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(M[r][col]))
+        M[col], M[pivot] = M[pivot], M[col]
+        for r in range(col + 1, n):
+            f = M[r][col] / M[col][col]
+            if f:
+                M[r] = [a - f * c for a, c in zip(M[r], M[col])]
+    x = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (M[r][n] - _dot(M[r][r + 1:n], x[r + 1:])) / M[r][r]
+    return x
+
+
+def _fit_pure(X: List[List[float]], y: List[float], logistic: bool, l2: float, iterations: int) -> List[float]:
+    """Same fit as _fit_numpy with lists; fine for the few thousand rows a scorer log holds."""
+    n, d = len(X), len(X[0])
+    columns = list(zip(*X))
+    # no penalty on the bias
+    penalty = [0.0] + [l2] * (d - 1)
+
+    def normal_matrix(weights: List[float]) -> List[List[float]]:
+        weighted = [list(map(operator.mul, col, weights)) for col in columns]
+        return [
+            [sum(map(operator.mul, weighted[i], columns[j])) / n + (penalty[i] if i == j else 0.0) for j in range(d)]
+            for i in range(d)
+        ]
+
+    if not logistic:
+        A = normal_matrix([1.0] * n)
+        return _solve(A, [sum(map(operator.mul, col, y)) / n for col in columns])
+
+    w = [0.0] * d
+    for _ in range(iterations):
+        p = [_sigmoid(_dot(w, x)) for x in X]
+        errors = [a - t for a, t in zip(p, y)]
+        grad = [sum(map(operator.mul, col, errors)) / n + penalty[j] * w[j] for j, col in enumerate(columns)]
+        step = _solve(normal_matrix([a * (1 - a) + 1e-9 for a in p]), grad)
+        w = [a - b for a, b in zip(w, step)]
+        if max(abs(v) for v in step) < 1e-6:
+            break
+    return w
+
+
+def _fit_numpy(np, X, y, logistic: bool, l2: float, iterations: int) -> List[float]:
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    penalty = l2 * np.eye(X.shape[1])
+    penalty[0, 0] = 0.0
+    if not logistic:
+        # ridge regression, closed form
+        return np.linalg.solve(X.T @ X / len(X) + penalty, X.T @ y / len(X)).tolist()
+
+    # logistic regression by Newton's method (IRLS)
+    w = np.zeros(X.shape[1])
+    for _ in range(iterations):
+        p = 1.0 / (1.0 + np.exp(-(X @ w)))
+        grad = X.T @ (p - y) / len(X) + penalty @ w
+        hess = (X.T * (p * (1 - p) + 1e-9)) @ X / len(X) + penalty
+        step = np.linalg.solve(hess, grad)
+        w -= step
+        if np.abs(step).max() < 1e-6:
+            break
+    return w.tolist()
+
+
+def train(examples: List[Dict], trivial_max: float = 3.9, threshold: float = 0.9, max_words: int = 6,
+          l2: float = 1e-3, iterations: int = 50) -> PreScorer:
+    """Ridge regression for the score heads, L2-regularized logistic regression (Newton) for "trivial"."""
+    X = [features(r["message"]) for r in examples]
+    targets = {
+        "trivial": [1.0 if (r["flirty"] + r["personality"]) / 2.0 < trivial_max else 0.0 for r in examples],
+        "flirty": [float(r["flirty"]) for r in examples],
+        "personality": [float(r["personality"]) for r in examples],
+    }
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    weights = {}
+    for head in HEADS:
+        logistic = head == "trivial"
+        if np is not None:
+            weights[head] = _fit_numpy(np, X, targets[head], logistic, l2, iterations)
+        else:
+            weights[head] = _fit_pure(X, targets[head], logistic, l2, iterations)
+
+    meta = {"trained_on": len(examples), "trained_at": int(time.time()), "solver": "numpy" if np else "python"}
+    return PreScorer(weights, trivial_max=trivial_max, threshold=threshold, max_words=max_words, meta=meta)
+
+
+# =============================
+# Replay report
+# =============================
+
+def report(model: PreScorer, examples: List[Dict], bins: int = 10) -> Dict:
+    """
+    How the local tier would have done on LLM-labelled messages:
+    coverage (share of scorer calls saved), agreement with the LLM on the
+    messages it would have handled, and calibration of p_trivial.
+    """
+    n = len(examples)
+    local = agree = 0
+    abs_err = {"flirty": 0.0, "personality": 0.0}
+    brier = 0.0
+    table = [[0, 0.0, 0] for _ in range(bins)]  # count, sum of p, trivial by the LLM
+
+    for r in examples:
+        pred, is_local = model.decide(r["message"])
+        llm_trivial = (r["flirty"] + r["personality"]) / 2.0 < model.trivial_max
+
+        brier += (pred.p_trivial - llm_trivial) ** 2
+        row = table[min(int(pred.p_trivial * bins), bins - 1)]
+        row[0] += 1
+        row[1] += pred.p_trivial
+        row[2] += llm_trivial
+
+        if is_local:
+            local += 1
+            agree += llm_trivial
+            abs_err["flirty"] += abs(pred.flirty - r["flirty"])
+            abs_err["personality"] += abs(pred.personality - r["personality"])
+
+    calibration = []
+    ece = 0.0
+    for i, (count, p_sum, hits) in enumerate(table):
+        if not count:
+            continue
+        predicted, observed = p_sum / count, hits / count
+        ece += count / n * abs(predicted - observed)
+        calibration.append({
+            "bin": f"{i / bins:.1f}-{(i + 1) / bins:.1f}",
+            "n": count,
+            "predicted": round(predicted, 3),
+            "observed": round(observed, 3),
+        })
+
+    return {
+        "messages": n,
+        "local": local,
+        "coverage": round(local / n, 3) if n else 0.0,
+        # local messages the LLM also rated trivial (same bucket, same level change)
+        "agreement": round(agree / local, 3) if local else None,
+        "mae": {k: round(v / local, 2) for k, v in abs_err.items()} if local else None,
+        "brier": round(brier / n, 4) if n else None,
+        "ece": round(ece, 4) if n else None,
+        "calibration": calibration,
+    }
+
+
+def print_report(r: Dict):
+    print(f"messages {r['messages']}  handled locally {r['local']} (coverage {r['coverage']:.1%})")
+    if r["local"]:
+        print(f"agreement with LLM {r['agreement']:.1%}  MAE flirty {r['mae']['flirty']}  personality {r['mae']['personality']}")
+    print(f"p_trivial: brier {r['brier']}  ECE {r['ece']}")
+    print(f"{'bin':>9} {'n':>6} {'predicted':>10} {'observed':>9}")
+    for row in r["calibration"]:
+        print(f"{row['bin']:>9} {row['n']:>6} {row['predicted']:>10.3f} {row['observed']:>9.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train / evaluate the local pre-scorer on scorer logs.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    t = sub.add_parser("train", help="fit weights on a scorer log")
+    t.add_argument("log", help="JSONL scorer log (SCORER_LOG)")
+    t.add_argument("-o", "--output", default="prescorer_weights.json")
+    t.add_argument("--trivial-max", type=float, default=3.9, help="average LLM score below which a message is trivial")
+    t.add_argument("--threshold", type=float, default=0.9, help="p_trivial needed to skip the LLM")
+    t.add_argument("--max-words", type=int, default=6, help="longer messages always go to the LLM")
+    t.add_argument("--holdout", type=float, default=0.2, help="share of rows kept back for the report")
+    t.add_argument("--seed", type=int, default=1)
+
+    rp = sub.add_parser("report", help="agreement/calibration of saved weights on a replay set")
+    rp.add_argument("log", help="JSONL scorer log to replay")
+    rp.add_argument("--weights", default="prescorer_weights.json")
+    rp.add_argument("--threshold", type=float, help="override the saved threshold")
+
+    for p in (t, rp):
+        p.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    examples = load_examples(args.log)
+    if not examples:
+        sys.exit(f"no LLM-scored rows in {args.log}")
+
+    if args.cmd == "train":
+        random.Random(args.seed).shuffle(examples)
+        cut = int(len(examples) * (1 - args.holdout)) if len(examples) > 1 else len(examples)
+        fit, holdout = examples[:cut], examples[cut:] or examples
+        model = train(fit, trivial_max=args.trivial_max, threshold=args.threshold, max_words=args.max_words)
+        model.save(args.output)
+        print(f"trained on {len(fit)} rows ({model.meta['solver']}), wrote {args.output}; holdout of {len(holdout)}:")
+    else:
+        model = PreScorer.load(args.weights)
+        if model is None:
+            sys.exit(f"no usable weights in {args.weights}")
+        if args.threshold is not None:
+            model.threshold = args.threshold
+        holdout = examples
+
+    r = report(model, holdout)
+    if args.json:
+        json.dump(r, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(r)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+from typing import Dict, List, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars per token for English), good enough for budgeting."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+class PromptBuilder:
+    """
+    Assembles a system prompt from named sections.
+
+    Static sections (persona, mode blocks) always come before per-turn
+    sections (facts, mood, rating), whatever order they're added in.
+    messages() puts the conversation history between the two, so the
+    request prefix (static prompt + earlier turns) stays byte-identical
+    from one turn to the next and provider-side prefix caching can hit.
+    sizes()/report() give per-section chars and tokens.
+    """
+
+    def __init__(self):
+        self._static: List[Tuple[str, str]] = []
+        self._dynamic: List[Tuple[str, str]] = []
+
+    def static(self, name: str, text: str) -> "PromptBuilder":
+        text = (text or "").strip()
+        if text:
+            self._static.append((name, text))
+        return self
+
+    def dynamic(self, name: str, text: str) -> "PromptBuilder":
+        text = (text or "").strip()
+        if text:
+            self._dynamic.append((name, text))
+        return self
+
+    def sections(self) -> List[Tuple[str, str]]:
+        return self._static + self._dynamic
+
+    def build(self) -> str:
+        return "\n\n".join(text for _, text in self.sections())
+
+    def messages(self, history: List[Dict[str, str]], user_message: str) -> List[Dict[str, str]]:
+        """Chat messages: static prompt, history, per-turn context, then the user's message."""
+        msgs = []
+        if self._static:
+            msgs.append({"role": "system", "content": "\n\n".join(text for _, text in self._static)})
+        msgs.extend(history)
+        if self._dynamic:
+            msgs.append({"role": "system", "content": "\n\n".join(text for _, text in self._dynamic)})
+        msgs.append({"role": "user", "content": user_message})
+        return msgs
+
+    def sizes(self) -> List[Tuple[str, int, int]]:
+        """(name, chars, estimated tokens) for every section, in prompt order."""
+        return [(name, len(text), estimate_tokens(text)) for name, text in self.sections()]
+
+    def report(self) -> str:
+        sizes = self.sizes()
+        parts = [f"{name}={tokens}t/{chars}c" for name, chars, tokens in sizes]
+        static_tokens = sum(estimate_tokens(text) for _, text in self._static)
+        total_tokens = sum(tokens for _, _, tokens in sizes)
+        parts.append(f"static={static_tokens}t total={total_tokens}t")
+        return " ".join(parts)
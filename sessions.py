@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+from history import ConversationHistory
+
+DEFAULT_OPENER = "ok, tell me something about you."
+
+
+class Session:
+    """In-memory state for one user. Slotted to keep per-user overhead small."""
+
+    __slots__ = (
+        "user_id",
+        "level",
+        "level_version",
+        "difficulty",
+        "boss_counter",
+        "boss_active",
+        "show_rating",
+        "authorized",
+        "dev",
+        "timezone",
+        "reminded_on",
+        "history",
+        "last_seen",
+    )
+
+    def __init__(self, user_id: int, history_budget: int = 600):
+        self.user_id = user_id
+        self.level = 1
+        self.level_version = 0  # Supabase level_version this level was read/written at
+        self.difficulty = "medium"
+        self.boss_counter = 0
+        self.boss_active = False
+        self.show_rating = False
+        self.authorized = False
+        self.dev = False
+        self.timezone = None  # IANA name from the "timezone" fact; None = bot default
+        self.reminded_on = None  # local date (ISO) of the last daily mood reminder
+        self.history = ConversationHistory(token_budget=history_budget)
+        self.last_seen = time.monotonic()
+
+    @property
+    def last_bot_message(self) -> str:
+        # derived from history instead of keeping a second copy of the reply
+        return self.history.last_assistant() or DEFAULT_OPENER
+
+    def as_dict(self) -> Dict:
+        return {
+            "level": self.level,
+            "difficulty": self.difficulty,
+            "boss_counter": self.boss_counter,
+            "boss_active": self.boss_active,
+            "show_rating": self.show_rating,
+            "authorized": self.authorized,
+            "dev": self.dev,
+            "timezone": self.timezone,
+            "last_bot_message": self.last_bot_message,
+        }
+
+
+class SessionStore:
+    """
+    Bounded user_id -> Session map.
+
+    Sessions idle for longer than `idle_ttl` seconds are dropped, and past
+    `max_size` the least recently active one is evicted. Everything in a
+    session can be rebuilt from Supabase facts, so callers just rehydrate
+    on a miss (see bot.get_user_state).
+    """
+
+    def __init__(self, max_size: int = 10000, idle_ttl: float = 6 * 3600):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._sessions: "OrderedDict[int, Session]" = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._sessions
+
+    def get(self, user_id: int) -> Optional[Session]:
+        s = self._sessions.get(user_id)
+        if s is None:
+            return None
+
+        now = time.monotonic()
+        if now - s.last_seen > self.idle_ttl:
+            self._evict(user_id)
+            return None
+
+        s.last_seen = now
+        self._sessions.move_to_end(user_id)
+        return s
+
+    def peek(self, user_id: int) -> Optional[Session]:
+        """The session if it's held, without counting as activity."""
+        return self._sessions.get(user_id)
+
+    def put(self, s: Session) -> Session:
+        s.last_seen = time.monotonic()
+        self._sessions[s.user_id] = s
+        self._sessions.move_to_end(s.user_id)
+        while len(self._sessions) > self.max_size:
+            self._evict(next(iter(self._sessions)))
+        return s
+
+    def sweep(self) -> int:
+        """Drop idle sessions; oldest are at the front, so stop at the first active one."""
+        now = time.monotonic()
+        dropped = 0
+        while self._sessions:
+            user_id, s = next(iter(self._sessions.items()))
+            if now - s.last_seen <= self.idle_ttl:
+                break
+            self._evict(user_id)
+            dropped += 1
+        return dropped
+
+    def most_recent(self, n: int) -> List[int]:
+        """Up to n user ids, most recently active first."""
+        return list(reversed(self._sessions.keys()))[:n]
+
+    # -----------------------------
+    # Snapshots (warm restart)
+    # -----------------------------
+
+    def dump_lines(self) -> List[str]:
+        """One compact NDJSON line per session, least recently active first."""
+        return encode_rows(self.snapshot_rows())
+
+    def snapshot_rows(self) -> List[Dict]:
+        """
+        Plain-data copy of every session, least recently active first, for
+        encode_rows(). Dev mode is left out on purpose: it has to be unlocked
+        again after a restart.
+        """
+        # last_seen is monotonic; convert to wall clock so it survives a restart
+        offset = time.time() - time.monotonic()
+        return [snapshot_row(s, offset) for s in self._sessions.values()]
+
+    async def snapshot_rows_async(self, chunk: int = 500) -> List[Dict]:
+        """snapshot_rows(), yielding to the event loop every `chunk` sessions."""
+        offset = time.time() - time.monotonic()
+        sessions = list(self._sessions.values())
+        rows = []
+        for i in range(0, len(sessions), chunk):
+            rows.extend(snapshot_row(s, offset) for s in sessions[i : i + chunk])
+            await asyncio.sleep(0)
+        return rows
+
+    def load_lines(self, lines, history_budget: int = 600) -> int:
+        """Restore sessions from dump_lines() output, skipping ones already idle too long."""
+        offset = time.time() - time.monotonic()
+        loaded = 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+                s = Session(int(row["u"]), history_budget=history_budget)
+                s.level = int(row.get("l", 1))
+                s.level_version = int(row.get("lv", 0))
+                s.difficulty = row.get("d", "medium")
+                s.boss_counter = int(row.get("bc", 0))
+                s.boss_active = bool(row.get("ba", False))
+                s.show_rating = bool(row.get("r", False))
+                s.authorized = bool(row.get("a", False))
+                s.timezone = row.get("tz")
+                s.reminded_on = row.get("rm")
+                s.history.summary = row.get("hs", "")
+                for role, text in row.get("ht", []):
+                    s.history.add(role, text)
+                last_seen = float(row.get("t", 0)) - offset
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            if time.monotonic() - last_seen > self.idle_ttl:
+                continue
+
+            # lines are oldest first, so plain puts rebuild the LRU order
+            self.put(s)
+            s.last_seen = last_seen
+            loaded += 1
+        return loaded
+
+    def save_snapshot(self, path: str) -> int:
+        """Write all sessions to path atomically (tmp file + rename)."""
+        lines = self.dump_lines()
+        write_lines(path, lines)
+        return len(lines)
+
+    def load_snapshot(self, path: str, history_budget: int = 600) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path, encoding="utf-8") as f:
+            return self.load_lines(f, history_budget=history_budget)
+
+    def authorized_users(self) -> Iterator[int]:
+        return (s.user_id for s in self.authorized_sessions())
+
+    def authorized_sessions(self) -> Iterator[Session]:
+        """Without touching recency (unlike get), so background jobs don't keep sessions alive."""
+        return (s for s in list(self._sessions.values()) if s.authorized)
+
+    def _evict(self, user_id: int):
+        if self._sessions.pop(user_id, None) is not None:
+            self.evictions += 1
+
+
+def snapshot_row(s: Session, offset: float) -> Dict:
+    return {
+        "u": s.user_id,
+        "t": round(s.last_seen + offset, 1),
+        "l": s.level,
+        "lv": s.level_version,
+        "d": s.difficulty,
+        "bc": s.boss_counter,
+        "ba": s.boss_active,
+        "r": s.show_rating,
+        "a": s.authorized,
+        "tz": s.timezone,
+        "rm": s.reminded_on,
+        "hs": s.history.summary,
+        "ht": [[role, text] for role, text, _ in s.history.turns],
+    }
+
+
+def encode_rows(rows: List[Dict]) -> List[str]:
+    return [json.dumps(row, separators=(",", ":"), ensure_ascii=False) for row in rows]
+
+
+def write_lines(path: str, lines: List[str]):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(line)
+            f.write("\n")
+    os.replace(tmp, path)
@@ -0,0 +1,599 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+import metrics
+import tracing
+from fact_cache import FactCache
+
+log = logging.getLogger("sofia")
+
+# =============================
+# Config
+# =============================
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_EDGE_URL = os.getenv("SUPABASE_EDGE_URL")
+SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")  # using anon for Edge Function auth
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+HTTP_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "8"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("SUPABASE_MAX_KEEPALIVE", "10"))
+
+FACT_CACHE_TTL = float(os.getenv("FACT_CACHE_TTL", "60"))
+FACT_CACHE_MAX_USERS = int(os.getenv("FACT_CACHE_MAX_USERS", "5000"))
+
+# user_plans lookups: a person is waiting on these (activation), so fail fast
+PLAN_LOOKUP_TIMEOUT = float(os.getenv("PLAN_LOOKUP_TIMEOUT", "3"))
+PLAN_LOOKUP_TTL = float(os.getenv("PLAN_LOOKUP_TTL", "60"))
+PLAN_LOOKUP_MAX_ROWS = int(os.getenv("PLAN_LOOKUP_MAX_ROWS", "5000"))
+
+# per-user calls in flight at once when a batch action isn't available on the Edge Function
+FALLBACK_CONCURRENCY = int(os.getenv("SUPABASE_FALLBACK_CONCURRENCY", "8"))
+
+# =============================
+# Shared keep-alive client
+# =============================
+# One pooled HTTP/2 client for the whole process, so every call reuses
+# the same TCP+TLS connections instead of paying a handshake each time.
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+        )
+    return _client
+
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _edge_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
+        "apikey": SUPABASE_ANON_KEY,
+        "Content-Type": "application/json",
+    }
+
+
+def _rest_headers() -> Dict[str, str]:
+    return {
+        "apikey": SUPABASE_SERVICE_ROLE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    }
+
+
+async def _edge(payload: Dict) -> httpx.Response:
+    action = payload["action"]
+    with metrics.SUPABASE_SECONDS.labels(action).time(), tracing.span(f"supabase.{action}"):
+        return await get_client().post(SUPABASE_EDGE_URL, headers=_edge_headers(), json=payload)
+
+
+# =============================
+# Supabase Edge Function helpers
+# =============================
+
+async def _fetch_facts(user_id: int) -> Optional[Dict[str, str]]:
+    """Loads facts straight from the Edge Function; None means the load failed."""
+    try:
+        resp = await _edge({"action": "load", "user_id": str(user_id)})
+
+        log.info(f"load_facts({user_id}) -> {resp.status_code} {resp.text}")
+
+        if resp.is_success:
+            data = resp.json() or []
+            return {row["key"]: row["value"] for row in data}
+        else:
+            log.error(f"load_facts failed with status {resp.status_code}: {resp.text}")
+    except Exception as e:
+        log.exception(f"load_facts exception: {e}")
+
+    return None
+
+
+fact_cache = FactCache(_fetch_facts, ttl=FACT_CACHE_TTL, max_users=FACT_CACHE_MAX_USERS)
+
+
+async def load_facts(user_id: int, fresh: bool = False) -> Dict[str, str]:
+    """
+    Returns the user's facts from the cache, hitting Supabase at most once
+    per TTL. fresh=True bypasses the cache (e.g. /reloadstate).
+    """
+    return await fact_cache.get(user_id, fresh=fresh)
+
+
+async def update_fact(user_id: int, key: str, value: str) -> bool:
+    try:
+        resp = await _edge({
+            "action": "update",
+            "user_id": str(user_id),
+            "key": key,
+            "value": value,
+        })
+
+        log.info(
+            f"update_fact(user_id={user_id}, key={key}, value={value}) "
+            f"-> {resp.status_code} {resp.text}"
+        )
+
+        if resp.is_success:
+            fact_cache.set(user_id, key, value)
+        return resp.is_success
+
+    except Exception as e:
+        log.exception(f"update_fact exception for key={key}: {e}")
+        return False
+
+
+async def delete_fact(user_id: int, key: str) -> bool:
+    try:
+        resp = await _edge({
+            "action": "delete",
+            "user_id": str(user_id),
+            "key": key,
+        })
+
+        log.info(f"delete_fact({user_id}, {key}) -> {resp.status_code} {resp.text}")
+        if resp.is_success:
+            fact_cache.delete(user_id, key)
+        return resp.is_success
+
+    except Exception as e:
+        log.exception(f"delete_fact error: {e}")
+        return False
+
+
+def _unsupported_action(resp: httpx.Response) -> bool:
+    """
+    True only if the Edge Function said it doesn't know the action (older
+    deployments): a 404, or a 400 whose error is "unknown action". Any other
+    400 is a real failure and must not be retried as per-key writes.
+    """
+    if resp.status_code == 404:
+        return True
+    if resp.status_code != 400:
+        return False
+    try:
+        data = resp.json() or {}
+    except ValueError:
+        return "unknown action" in resp.text.lower()
+    if not isinstance(data, dict):
+        return False
+    return data.get("code") == "unknown_action" or "unknown action" in str(data.get("error") or "").lower()
+
+
+async def update_facts(user_id: int, facts: Dict[str, str]) -> bool:
+    """Upserts several facts in one round-trip via the multi-key Edge action."""
+    if not facts:
+        return True
+
+    try:
+        resp = await _edge({
+            "action": "update_many",
+            "user_id": str(user_id),
+            "facts": facts,
+        })
+
+        log.info(f"update_facts(user_id={user_id}, keys={list(facts)}) -> {resp.status_code} {resp.text}")
+
+        if _unsupported_action(resp):
+            log.warning("update_many not supported by Edge Function, falling back to per-key updates")
+            results = await asyncio.gather(*(update_fact(user_id, k, v) for k, v in facts.items()))
+            return all(results)
+
+        if resp.is_success:
+            for k, v in facts.items():
+                fact_cache.set(user_id, k, v)
+        else:
+            log.error(f"update_facts failed with status {resp.status_code}: {resp.text}")
+        return resp.is_success
+
+    except Exception as e:
+        log.exception(f"update_facts exception for keys={list(facts)}: {e}")
+        return False
+
+
+async def delete_facts(user_id: int, keys: Iterable[str]) -> bool:
+    """Deletes several facts in one round-trip via the multi-key Edge action."""
+    keys = list(keys)
+    if not keys:
+        return True
+
+    try:
+        resp = await _edge({
+            "action": "delete_many",
+            "user_id": str(user_id),
+            "keys": keys,
+        })
+
+        log.info(f"delete_facts({user_id}, {len(keys)} keys) -> {resp.status_code} {resp.text}")
+
+        if _unsupported_action(resp):
+            log.warning("delete_many not supported by Edge Function, falling back to per-key deletes")
+            results = await asyncio.gather(*(delete_fact(user_id, k) for k in keys))
+            return all(results)
+
+        if resp.is_success:
+            for k in keys:
+                fact_cache.delete(user_id, k)
+        else:
+            log.error(f"delete_facts failed with status {resp.status_code}: {resp.text}")
+        return resp.is_success
+
+    except Exception as e:
+        log.exception(f"delete_facts error: {e}")
+        return False
+
+
+async def increment_counters(
+    key: str, deltas: Dict[int, int], batch_id: str
+) -> Optional[Tuple[Dict[int, int], bool]]:
+    """
+    Atomically adds deltas to a numeric fact for many users in one round-trip.
+    Returns ({user_id: new total} for the users it was applied to, replayed),
+    or None if the batch failed as a whole. The Edge function applies each
+    `batch_id` once, so a retry of a batch that did land isn't counted twice;
+    it answers such a retry with the original totals and replayed=True.
+    """
+    if not deltas:
+        return {}, False
+
+    try:
+        resp = await _edge({
+            "action": "increment",
+            "key": key,
+            "batch_id": batch_id,
+            "deltas": {str(uid): n for uid, n in deltas.items()},
+        })
+
+        log.info(f"increment_counters({key}, {len(deltas)} users) -> {resp.status_code}")
+
+        if _unsupported_action(resp):
+            log.warning("increment not supported by Edge Function, falling back to per-user read-modify-write")
+            return await _increment_fallback(key, deltas)
+
+        if not resp.is_success:
+            log.error(f"increment_counters failed with status {resp.status_code}: {resp.text}")
+            return None
+
+        body = resp.json() or {}
+        values = {int(uid): int(v) for uid, v in (body.get("values") or {}).items()}
+        replayed = bool(body.get("duplicate"))
+        for uid, total in values.items():
+            if replayed:
+                # totals from when it first landed; newer increments may be on top
+                fact_cache.invalidate(uid)
+            else:
+                fact_cache.set(uid, key, str(total))
+        return values, replayed
+
+    except Exception as e:
+        log.exception(f"increment_counters exception: {e}")
+        return None
+
+
+async def scan_users(require: str, keys: Iterable[str], page_size: int = 1000) -> Optional[Dict[int, Dict[str, str]]]:
+    """
+    Every user that has fact `require`, with their values for `keys`, paged
+    through the Edge "scan" action. None if the action is unavailable or a
+    page failed, so callers can fall back to what they hold in memory.
+    """
+    keys = list(keys)
+    users: Dict[int, Dict[str, str]] = {}
+    after = None
+
+    while True:
+        try:
+            resp = await _edge({"action": "scan", "require": require, "keys": keys, "after": after, "limit": page_size})
+        except Exception as e:
+            log.exception(f"scan_users error: {e}")
+            return None
+
+        if _unsupported_action(resp):
+            log.warning("scan not supported by Edge Function")
+            return None
+        if not resp.is_success:
+            log.error(f"scan_users failed with status {resp.status_code}: {resp.text}")
+            return None
+
+        data = resp.json() or {}
+        for uid, facts in (data.get("users") or {}).items():
+            users[int(uid)] = {k: str(v) for k, v in (facts or {}).items()}
+        after = data.get("next")
+        if not after:
+            return users
+
+
+async def _gather_bounded(coros: Iterable) -> List:
+    """asyncio.gather with at most FALLBACK_CONCURRENCY of them running at once."""
+    sem = asyncio.Semaphore(FALLBACK_CONCURRENCY)
+
+    async def one(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(one(c) for c in coros))
+
+
+async def set_fact_for_users(key: str, values: Dict[int, str]) -> bool:
+    """Writes one fact for many users in one round-trip (Edge "set_many")."""
+    if not values:
+        return True
+
+    try:
+        resp = await _edge({
+            "action": "set_many",
+            "key": key,
+            "values": {str(uid): v for uid, v in values.items()},
+        })
+
+        log.info(f"set_fact_for_users({key}, {len(values)} users) -> {resp.status_code}")
+
+        if _unsupported_action(resp):
+            log.warning("set_many not supported by Edge Function, falling back to per-user updates")
+            results = await _gather_bounded(update_fact(uid, key, v) for uid, v in values.items())
+            return all(results)
+
+        if resp.is_success:
+            for uid, v in values.items():
+                fact_cache.set(uid, key, v)
+        else:
+            log.error(f"set_fact_for_users failed with status {resp.status_code}: {resp.text}")
+        return resp.is_success
+
+    except Exception as e:
+        log.exception(f"set_fact_for_users exception: {e}")
+        return False
+
+
+async def _increment_fallback(key: str, deltas: Dict[int, int]) -> Tuple[Dict[int, int], bool]:
+    # not atomic against other writers (nor idempotent), but no worse than the old per-turn write
+    async def one(uid: int, n: int) -> Optional[int]:
+        facts = await load_facts(uid, fresh=True)
+        try:
+            total = int(facts.get(key) or 0) + n
+        except ValueError:
+            total = n
+        return total if await update_fact(uid, key, str(total)) else None
+
+    totals = await _gather_bounded(one(uid, n) for uid, n in deltas.items())
+    return {uid: t for uid, t in zip(deltas, totals) if t is not None}, False
+
+
+async def cas_fact(
+    user_id: int,
+    key: str,
+    value: str,
+    expected_version: int,
+    force: bool = False,
+    expected_value: Optional[str] = None,
+) -> Tuple[bool, Optional[str], Optional[int]]:
+    """
+    Compare-and-swap a versioned fact: writes `value` only if `<key>_version`
+    is still `expected_version` (or always, with force=True), bumping it.
+    With `expected_value`, the stored value must also still be that, which
+    catches edits made without a version bump (e.g. in the dashboard).
+
+    Returns (ok, stored value, stored version). On a version conflict ok is
+    False and value/version are what Supabase has now; if the call itself
+    failed, version is None.
+    """
+    version_key = f"{key}_version"
+    try:
+        resp = await _edge({
+            "action": "cas",
+            "user_id": str(user_id),
+            "key": key,
+            "value": value,
+            "version_key": version_key,
+            "expected": str(expected_version),
+            "expected_value": expected_value,
+            "force": force,
+        })
+
+        log.info(f"cas_fact(user_id={user_id}, {key}={value}, expected v{expected_version}, force={force}) -> {resp.status_code} {resp.text}")
+
+        if _unsupported_action(resp):
+            log.warning("cas not supported by Edge Function, falling back to a versioned read-compare-write")
+            return await _cas_fallback(user_id, key, value, version_key, expected_version, expected_value, force)
+
+        if resp.is_success or resp.status_code == 409:
+            data = resp.json() or {}
+            stored = data.get("value")
+            version = int(data.get("version") or 0)
+            if stored is not None:
+                fact_cache.set(user_id, key, str(stored))
+            fact_cache.set(user_id, version_key, str(version))
+            return resp.is_success, stored, version
+
+        log.error(f"cas_fact failed with status {resp.status_code}: {resp.text}")
+
+    except Exception as e:
+        log.exception(f"cas_fact exception for key={key}: {e}")
+
+    return False, None, None
+
+
+async def _cas_fallback(
+    user_id: int,
+    key: str,
+    value: str,
+    version_key: str,
+    expected_version: int,
+    expected_value: Optional[str],
+    force: bool,
+) -> Tuple[bool, Optional[str], Optional[int]]:
+    # re-read first, so edits made elsewhere (dashboard, /setlevel) are seen as conflicts;
+    # only a write racing this read can still be lost
+    facts = await load_facts(user_id, fresh=True)
+    try:
+        current = int(facts.get(version_key) or 0)
+    except ValueError:
+        current = 0
+
+    if not force and (current != expected_version or _value_changed(facts.get(key), expected_value)):
+        return False, facts.get(key), current
+
+    version = current + 1
+    if not await update_facts(user_id, {key: value, version_key: str(version)}):
+        return False, None, None
+    return True, value, version
+
+
+def _value_changed(stored: Optional[str], expected: Optional[str]) -> bool:
+    return expected is not None and stored is not None and stored != expected
+
+
+async def get_plan_by_email(email: str) -> Optional[str]:
+    """Returns the plan the Edge Function has on record for this email, or None."""
+    try:
+        resp = await _edge({"action": "get_plan_by_email", "email": email})
+    except Exception as e:
+        log.exception(f"get_plan_by_email error: {e}")
+        return None
+
+    if not resp.is_success:
+        return None
+
+    return (resp.json() or {}).get("plan")
+
+
+# =============================
+# PostgREST user_plans helpers
+# =============================
+
+# email -> (monotonic time, user_plans row), oldest first; misses aren't cached (the buyer may retry)
+_plan_rows: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+
+def _cache_plan_row(email: str, row: Dict, now: float):
+    _plan_rows[email] = (now, row)
+    _plan_rows.move_to_end(email)
+    # expired rows sit at the front, then the size cap
+    while _plan_rows:
+        loaded_at, _ = next(iter(_plan_rows.values()))
+        if now - loaded_at < PLAN_LOOKUP_TTL and len(_plan_rows) <= PLAN_LOOKUP_MAX_ROWS:
+            break
+        _plan_rows.popitem(last=False)
+
+
+def forget_user_plan(email: str):
+    """Drop a cached user_plans row, e.g. when the plan-change webhook reports it."""
+    _plan_rows.pop(email.lower().strip(), None)
+
+
+async def fetch_user_plan(email: str, fresh: bool = False) -> Optional[Dict]:
+    url = f"{SUPABASE_URL}/rest/v1/user_plans"
+
+    cached = _plan_rows.get(email)
+    if cached and not fresh and time.monotonic() - cached[0] < PLAN_LOOKUP_TTL:
+        return dict(cached[1])
+
+    try:
+        with metrics.SUPABASE_SECONDS.labels("fetch_user_plan").time(), tracing.span("supabase.fetch_user_plan"):
+            resp = await get_client().get(
+                url,
+                headers=_rest_headers(),
+                params={"select": "*", "email": f"eq.{email}"},
+                timeout=PLAN_LOOKUP_TIMEOUT,
+            )
+    except Exception as e:
+        log.exception(f"fetch_user_plan error: {e}")
+        return None
+
+    if not resp.is_success:
+        log.error(f"ERROR fetching user_plan: {resp.text}")
+        return None
+
+    data = resp.json()
+
+    if not data:
+        return None
+
+    # data[0] contains ONLY: email, plan, product_id, product_name, updated_at
+    _cache_plan_row(email, data[0], time.monotonic())
+    return dict(data[0])
+
+
+async def fetch_user_plans(emails: Iterable[str], batch: int = 100) -> Optional[List[Dict]]:
+    """user_plans rows for many emails, `batch` per request; None if any request failed."""
+    emails = sorted(set(emails))
+    url = f"{SUPABASE_URL}/rest/v1/user_plans"
+    rows: List[Dict] = []
+
+    for i in range(0, len(emails), batch):
+        chunk = emails[i:i + batch]
+        # PostgREST list syntax; quote so commas/dots inside emails are literal
+        quoted = ",".join('"{}"'.format(e.replace('"', "")) for e in chunk)
+        try:
+            with metrics.SUPABASE_SECONDS.labels("fetch_user_plans").time():
+                resp = await get_client().get(
+                    url,
+                    headers=_rest_headers(),
+                    params={"select": "*", "email": f"in.({quoted})"},
+                )
+        except Exception as e:
+            log.exception(f"fetch_user_plans error: {e}")
+            return None
+
+        if not resp.is_success:
+            log.error(f"ERROR fetching user_plans: {resp.text}")
+            return None
+
+        now = time.monotonic()
+        for row in resp.json() or []:
+            if row.get("email"):
+                _cache_plan_row(row["email"], row, now)
+            rows.append(row)
+
+    return rows
+
+
+async def set_email_owner(email: str, telegram_id: int) -> bool:
+    """Assign a telegram_id to an email in user_plans (locks the account)."""
+    url = f"{SUPABASE_URL}/rest/v1/user_plans"
+
+    headers = {
+        **_rest_headers(),
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal",
+    }
+
+    try:
+        with metrics.SUPABASE_SECONDS.labels("set_email_owner").time(), tracing.span("supabase.set_email_owner"):
+            resp = await get_client().patch(
+                url,
+                headers=headers,
+                params={"email": f"eq.{email}"},
+                json={"telegram_id": str(telegram_id)},
+            )
+    except Exception as e:
+        log.exception(f"set_email_owner error: {e}")
+        return False
+
+    if not resp.is_success:
+        log.error(f"ERROR setting telegram_id: {resp.text}")
+        return False
+
+    cached = _plan_rows.get(email)
+    if cached:
+        cached[1]["telegram_id"] = str(telegram_id)
+    return True
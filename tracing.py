@@ -0,0 +1,250 @@
+"""
+Lightweight per-update tracing.
+
+Every update handled by chat() gets a trace id, and code along the way
+records timed spans with `with tracing.span("name"):`. Spans find their
+trace through a contextvar, so they nest correctly across awaits and
+asyncio.gather. Finished traces are kept in memory per user (for /traces)
+and exported as JSON lines (TRACE_FILE) and/or OTLP/HTTP JSON
+(TRACE_OTLP_URL, e.g. a local collector on http://127.0.0.1:4318).
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import secrets
+import contextvars
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+import httpx
+
+log = logging.getLogger("sofia")
+
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL")
+TRACES_PER_USER = int(os.getenv("TRACES_PER_USER", "5"))
+TRACE_MAX_USERS = int(os.getenv("TRACE_MAX_USERS", "1000"))
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("span", default=None)
+
+# user_id -> last few finished traces
+_recent: "OrderedDict[int, Deque[Trace]]" = OrderedDict()
+_otlp_client: Optional[httpx.AsyncClient] = None
+_export_tasks = set()
+# JSON lines waiting for the TRACE_FILE writer; file I/O runs in a thread, off the loop
+_file_buffer: List[str] = []
+_file_writer: Optional[asyncio.Task] = None
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "user_id", "attrs", "start_wall", "start", "end", "spans")
+
+    def __init__(self, name: str, user_id: int, **attrs):
+        self.trace_id = secrets.token_hex(16)
+        self.name = name
+        self.user_id = user_id
+        self.attrs = attrs
+        self.start_wall = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans: List[Dict] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def as_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "user_id": self.user_id,
+            "attrs": self.attrs,
+            "start": self.start_wall,
+            "duration_ms": round(self.duration * 1000, 1),
+            "spans": self.spans,
+        }
+
+
+class span:
+    """Times a block as a span of the current trace; a no-op outside a trace."""
+
+    __slots__ = ("name", "attrs", "_trace", "_id", "_parent", "_token", "_start")
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self._trace = _current_trace.get()
+        if self._trace is not None:
+            self._id = secrets.token_hex(8)
+            self._parent = _current_span.get()
+            self._token = _current_span.set(self._id)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        t = self._trace
+        if t is None:
+            return False
+        end = time.perf_counter()
+        _current_span.reset(self._token)
+        # background work that outlives the turn doesn't get attached
+        if t.end is None:
+            record = {
+                "span_id": self._id,
+                "parent_id": self._parent,
+                "name": self.name,
+                "start_ms": round((self._start - t.start) * 1000, 1),
+                "duration_ms": round((end - self._start) * 1000, 1),
+            }
+            if self.attrs:
+                record["attrs"] = self.attrs
+            if exc_type is not None:
+                record["error"] = exc_type.__name__
+            t.spans.append(record)
+        return False
+
+
+class trace:
+    """Root of one update's trace: `with tracing.trace("chat", user_id):`."""
+
+    def __init__(self, name: str, user_id: int, **attrs):
+        self.trace = Trace(name, user_id, **attrs)
+
+    def __enter__(self) -> Trace:
+        self._token = _current_trace.set(self.trace)
+        self._span_token = _current_span.set(None)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._span_token)
+        _current_trace.reset(self._token)
+        self.trace.end = time.perf_counter()
+        _finish(self.trace)
+        return False
+
+
+def current_trace_id() -> Optional[str]:
+    t = _current_trace.get()
+    return t.trace_id if t else None
+
+
+def recent_traces(user_id: int) -> List[Trace]:
+    return list(_recent.get(user_id, ()))
+
+
+def breakdown(t: Trace) -> str:
+    """Human-readable per-stage summary of one trace (top-level spans, children indented)."""
+    children: Dict[Optional[str], List[Dict]] = {}
+    for s in t.spans:
+        children.setdefault(s["parent_id"], []).append(s)
+
+    lines = [f"{t.name} {t.trace_id[:8]} {t.duration * 1000:.0f}ms"]
+
+    def walk(parent: Optional[str], depth: int):
+        for s in sorted(children.get(parent, []), key=lambda s: s["start_ms"]):
+            err = f" ({s['error']})" if "error" in s else ""
+            lines.append(f"{'  ' * depth}- {s['name']} {s['duration_ms']:.0f}ms @{s['start_ms']:.0f}{err}")
+            walk(s["span_id"], depth + 1)
+
+    walk(None, 1)
+    return "\n".join(lines)
+
+
+def _finish(t: Trace):
+    global _file_writer
+    q = _recent.get(t.user_id)
+    if q is None:
+        q = _recent[t.user_id] = deque(maxlen=TRACES_PER_USER)
+        while len(_recent) > TRACE_MAX_USERS:
+            _recent.popitem(last=False)
+    _recent.move_to_end(t.user_id)
+    q.append(t)
+
+    if TRACE_FILE:
+        _file_buffer.append(json.dumps(t.as_dict(), separators=(",", ":")) + "\n")
+        if _file_writer is None or _file_writer.done():
+            _file_writer = asyncio.ensure_future(_write_trace_file())
+
+    if TRACE_OTLP_URL:
+        task = asyncio.ensure_future(_export_otlp(t))
+        _export_tasks.add(task)
+        task.add_done_callback(_export_tasks.discard)
+
+
+def to_otlp(t: Trace) -> Dict:
+    """OTLP/HTTP JSON body for one trace."""
+    base_ns = int(t.start_wall * 1e9)
+
+    def attrs(d: Dict) -> List[Dict]:
+        return [{"key": k, "value": {"stringValue": str(v)}} for k, v in d.items()]
+
+    root_id = t.trace_id[:16]
+    spans = [{
+        "traceId": t.trace_id,
+        "spanId": root_id,
+        "name": t.name,
+        "kind": 2,
+        "startTimeUnixNano": str(base_ns),
+        "endTimeUnixNano": str(base_ns + int(t.duration * 1e9)),
+        "attributes": attrs({"user_id": t.user_id, **t.attrs}),
+    }]
+    for s in t.spans:
+        start_ns = base_ns + int(s["start_ms"] * 1e6)
+        spans.append({
+            "traceId": t.trace_id,
+            "spanId": s["span_id"],
+            "parentSpanId": s["parent_id"] or root_id,
+            "name": s["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(s["duration_ms"] * 1e6)),
+            "attributes": attrs(s.get("attrs", {})),
+            "status": {"code": 2, "message": s["error"]} if "error" in s else {},
+        })
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": attrs({"service.name": "sofia-bot"})},
+            "scopeSpans": [{"scope": {"name": "sofia.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+def _append_lines(lines: List[str]):
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+async def _write_trace_file():
+    # whatever finished while the previous batch was being written goes out next
+    while _file_buffer:
+        lines = _file_buffer[:]
+        del _file_buffer[:]
+        try:
+            await asyncio.to_thread(_append_lines, lines)
+        except OSError as e:
+            log.warning(f"trace export failed: {e}")
+
+
+async def _export_otlp(t: Trace):
+    global _otlp_client
+    if _otlp_client is None:
+        _otlp_client = httpx.AsyncClient(timeout=2)
+    try:
+        await _otlp_client.post(TRACE_OTLP_URL.rstrip("/") + "/v1/traces", json=to_otlp(t))
+    except Exception as e:
+        log.warning(f"OTLP trace export failed: {e}")
+
+
+async def aclose():
+    global _otlp_client
+    if _file_writer is not None:
+        await _file_writer
+    if _otlp_client is not None:
+        await _otlp_client.aclose()
+        _otlp_client = None
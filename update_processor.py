@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+log = logging.getLogger("sofia")
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates concurrently, but one at a time per user.
+
+    Each user's updates wait on that user's lock (asyncio locks are FIFO, so
+    they run in arrival order) and only then take one of `max_concurrent`
+    global slots. A user with a backlog therefore never holds slots other
+    users could be served with. `max_pending` bounds how many updates PTB
+    admits at once in total, including the ones waiting on a user lock.
+    """
+
+    def __init__(self, max_concurrent: int = 64, max_pending: int = 4096):
+        super().__init__(max(max_pending, max_concurrent))
+        self.max_concurrent = max_concurrent
+        self._slots = asyncio.BoundedSemaphore(max_concurrent)
+        # user_id -> [lock, number of updates holding or waiting on it]
+        self._locks: Dict[int, List[Any]] = {}
+        self.active = 0
+
+    @staticmethod
+    def user_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.user_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, coroutine: Awaitable[Any]):
+        async with self._slots:
+            self.active += 1
+            try:
+                await coroutine
+            finally:
+                self.active -= 1
+
+    def waiting_users(self) -> int:
+        """Users with at least one update queued behind the one being handled."""
+        return sum(1 for _, n in self._locks.values() if n > 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
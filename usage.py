@@ -0,0 +1,132 @@
+import uuid
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+log = logging.getLogger("sofia")
+
+# flusher({user_id: delta}, batch_id) -> ({user_id: new total} for the users it applied, replayed)
+# or None if the outcome is unknown; replayed = the server had already applied this batch_id
+Flusher = Callable[[Dict[int, int], str], Awaitable[Optional[Tuple[Dict[int, int], bool]]]]
+# rezero(user_ids) writes the reset value again for users reset while their increment was in flight
+Rezero = Callable[[Iterable[int]], Awaitable[object]]
+
+
+class UsageCounters:
+    """
+    Per-user message counters kept in process and flushed in batches.
+
+    Turns only bump a local delta, so counting a message costs no network
+    call and concurrent turns can't lose increments. flush() sends all
+    deltas in one atomic server-side increment; the flusher writes the new
+    totals through to the fact cache, so current() = stored value + deltas
+    not yet applied.
+
+    Every batch carries an id the server uses to drop duplicates. A batch
+    whose outcome is unknown (failed, or timed out after the server applied
+    it) is resent as-is with the same id on later flushes, so it can't be
+    counted twice; it doesn't hold back new batches. Users the server
+    answered for but didn't apply go back to pending and get a fresh id.
+    Users discard()ed while their increment is in flight are re-zeroed once
+    the batch settles, so the increment can't land on top of a reset.
+    """
+
+    def __init__(self, flusher: Flusher, max_batch: int = 500, rezero: Optional[Rezero] = None):
+        self.flusher = flusher
+        self.max_batch = max_batch
+        self.rezero = rezero
+        self._pending: Dict[int, int] = {}
+        # sent but not yet acknowledged; still counted by current()
+        self._inflight: Dict[int, int] = {}
+        # (batch id, deltas) of batches whose outcome is unknown; resent with the same id
+        self._retry: List[Tuple[str, Dict[int, int]]] = []
+        # users reset while in _inflight or _retry
+        self._reset: Set[int] = set()
+        self._lock = asyncio.Lock()
+
+    def add(self, user_id: int, n: int = 1):
+        self._pending[user_id] = self._pending.get(user_id, 0) + n
+
+    def unflushed(self, user_id: int) -> int:
+        n = self._pending.get(user_id, 0)
+        if user_id not in self._reset:
+            n += self._inflight.get(user_id, 0)
+        for _, batch in self._retry:
+            n += batch.get(user_id, 0)
+        return n
+
+    def current(self, user_id: int, stored: int) -> int:
+        return stored + self.unflushed(user_id)
+
+    def discard(self, user_id: int):
+        """Forget unflushed messages, e.g. when the counter is reset to 0."""
+        self._pending.pop(user_id, None)
+        for _, batch in self._retry:
+            if batch.pop(user_id, None) is not None:
+                # the server may already have applied it; rezero once it settles
+                self._reset.add(user_id)
+        if user_id in self._inflight:
+            self._reset.add(user_id)
+
+    def __len__(self) -> int:
+        return len(self._pending) + sum(len(batch) for _, batch in self._retry)
+
+    async def flush(self) -> int:
+        """Push pending deltas to the server; returns how many users were newly applied."""
+        flushed = 0
+        async with self._lock:
+            # unknown outcomes first, each tried once per flush
+            for entry in list(self._retry):
+                batch_id, batch = entry
+                result = await self._send(batch_id, batch, inflight=False)
+                self._retry.remove(entry)
+                flushed += self._settle(batch_id, batch, result)
+
+            # users in the current pending set only, so requeued ones wait for the next flush
+            todo = list(self._pending)
+            for i in range(0, len(todo), self.max_batch):
+                batch = {u: self._pending.pop(u) for u in todo[i : i + self.max_batch] if u in self._pending}
+                batch_id = uuid.uuid4().hex
+                result = await self._send(batch_id, batch, inflight=True)
+                flushed += self._settle(batch_id, batch, result)
+                if result is None:
+                    break
+
+            # only once nothing for them is in flight (or awaiting a retry) any more
+            reset = {u for u in self._reset if not any(u in batch for _, batch in self._retry)}
+            if reset and self.rezero:
+                try:
+                    await self.rezero(reset)
+                except Exception as e:
+                    log.exception(f"usage rezero error: {e}")
+            self._reset -= reset
+        return flushed
+
+    async def _send(self, batch_id: str, batch: Dict[int, int], inflight: bool):
+        if not batch:
+            return {}, False
+        # retries stay in _retry while they're sent, so they're counted once
+        if inflight:
+            self._inflight = batch
+        try:
+            return await self.flusher(batch, batch_id)
+        except Exception as e:
+            log.exception(f"usage flush error: {e}")
+            return None
+        finally:
+            self._inflight = {}
+
+    def _settle(self, batch_id: str, batch: Dict[int, int], result) -> int:
+        if result is None:
+            rest = {u: n for u, n in batch.items() if u not in self._reset}
+            if rest:
+                self._retry.append((batch_id, rest))
+            return 0
+
+        totals, replayed = result
+        for u, n in batch.items():
+            # answered but not applied (e.g. the per-user fallback failed): a new batch next time
+            if u not in totals and u not in self._reset:
+                self._pending[u] = self._pending.get(u, 0) + n
+        # a replay was already counted when it first landed
+        return 0 if replayed else len(totals)